@@ -5,26 +5,45 @@ Given a list of distribution/component targets, this script will auto-resolve wh
 or snapshots they point to.
 """
 import argparse
+import codecs
+import collections
+import concurrent.futures
 import enum
+import glob
+import gzip
+import hashlib
 import html
 import json
+import multiprocessing
 import os.path
+import re
+import select
+import shelve
 import shutil
+import socket
 import subprocess
+import sys
 import tarfile
 import time
 import traceback
 import xml.etree.ElementTree
 
 # External modules
-import requests
 import requests_unixsocket
 import yaml
 
+import runmetrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # Constants
 _USCAN_WATCH_FILE_NOT_FOUND = "watch file not found"
 _USCAN_FAILED = "failed to get status"
 _USCAN_PROBABLY_NATIVE = "N/A package is native"
+_USCAN_HOST_REGEX = re.compile(r'https?://([^/\s\\]+)')
 _USCAN_FORMAT = {
     "newer package available": "💡",
     "only older package available": "⁉️",
@@ -34,6 +53,56 @@ _USCAN_FORMAT = {
     _USCAN_PROBABLY_NATIVE: "↷",
 }
 
+def _iter_json_array(chunks):
+    """
+    Incrementally parses a JSON array of objects from an iterable of bytes chunks, yielding each element
+    as soon as it has been received. This avoids holding the entire response (and its parsed form) in memory.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buf = buf[pos:] + text_decoder.decode(chunk)
+        pos = 0
+        while True:
+            # Skip whitespace and separators between elements
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError(f"Expected a JSON array, got {buf[pos:pos+100]!r}")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                element, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Incomplete element; wait for more data
+                break
+            yield element
+    raise ValueError(f"Truncated JSON array: {buf[pos:pos+100]!r}")
+
+def _write_file_atomic(filename, data):
+    """Writes data to a file via a temporary file and rename, so that readers never see a partial file."""
+    tmp_filename = f'{filename}.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
+
+def _get_pool_prefix(source_name):
+    """Returns the pool folder prefix for a source package name."""
+    # Debian convention uses the first character of the source package name to split
+    # the URL, or the first four letters (libX) if the source package starts with "lib"
+    if source_name.startswith('lib'):
+        return source_name[:4]
+    return source_name[0]
+
 class SourceExtractionError(RuntimeError):
     pass
 
@@ -47,13 +116,18 @@ class PackageEntry():
     """
     Represents a package entry.
     """
-    def __init__(self, name, version, architecture, source_name, component, files, description=None, depends=None, recommends=None, suggests=None, vcs_browser=None):
+    # Large mirrored snapshots can have tens of thousands of packages, so avoid a per-instance __dict__
+    __slots__ = ('name', 'version', 'arch', 'source_name', 'component', 'files', 'checksums',
+                 'description', 'depends', 'recommends', 'suggests', 'vcs_browser')
+
+    def __init__(self, name, version, architecture, source_name, component, files, description=None, depends=None, recommends=None, suggests=None, vcs_browser=None, checksums=None):
         self.name = name
         self.version = version
         self.arch = architecture  # Architecture
         self.source_name = source_name  # Corresponding source package name
         self.component = component
         self.files = files
+        self.checksums = checksums or {}  # Mapping of filename to MD5 checksum, if known
         self.description = description
         # Optional fields
         self.depends = depends
@@ -68,12 +142,7 @@ class PackageEntry():
         # e.g.
         #    https://deb.debian.org/debian/pool/main/v/variety/variety_0.8.3-1_all.deb
         #    https://deb.debian.org/debian/pool/main/liba/libayatana-indicator/libayatana-indicator_0.6.2-3.dsc
-        # Note: Debian convention uses the first character of the source package name to split
-        # the URL, or the first four letters (libX) if the source package starts with "lib"
-        if self.source_name.startswith('lib'):
-            prefix = self.source_name[:4]
-        else:
-            prefix = self.source_name[0]
+        prefix = _get_pool_prefix(self.source_name)
         return f'{pool_root_url}/{self.component}/{prefix}/{self.source_name}/{filename}'
 
     def get_download_url(self, pool_root_url):
@@ -86,12 +155,8 @@ class PackageEntry():
 
         return self._resolve_pool_url(pool_root_url, filename)
 
-    def extract_metadata(self, pool_directory, maxsize, extract_changelog=True, extract_watchfile=True):
-        """
-        Extract debian/watch and debian/changelog from a source package.
-
-        This returns a tuple on success: (<changelog data>, <watch data>)
-        """
+    def _get_source_tarball(self):
+        """Returns the filename of the tarball containing the debian/ folder of a source package."""
         if self.arch != 'source':
             raise NotImplementedError("Only source packages are supported for extraction")
 
@@ -99,61 +164,385 @@ class PackageEntry():
         debian_tar = [entry for entry in self.files
                       if '.tar' in entry and '.orig' not in entry]
         try:
-            debian_tar = debian_tar[0]
+            return debian_tar[0]
         except IndexError:
             raise SourceNotFoundError("Could not find source tarball in files: %s" % self.files) from None
 
-        debian_tar = self._resolve_pool_url(pool_directory, debian_tar)
+    def get_cache_key(self, pool_directory):
+        """
+        Returns a key identifying the contents of this source package's tarball, for use with ExtractionCache.
+
+        This uses the tarball's checksum from aptly when available, and falls back to its size and mtime on disk.
+        """
+        filename = self._get_source_tarball()
+        checksum = self.checksums.get(filename)
+        if not checksum:
+            st = os.stat(self._resolve_pool_url(pool_directory, filename))
+            checksum = f'{st.st_size}-{st.st_mtime_ns}'
+        return f'{self.name}_{self.version}_{checksum}'
+
+    def extract_metadata(self, pool_directory, maxsize, extract_changelog=True, extract_watchfile=True):
+        """
+        Extract debian/watch and debian/changelog from a source package.
+
+        This returns a tuple on success: (<changelog data>, <watch data>)
+        """
+        debian_tar = self._resolve_pool_url(pool_directory, self._get_source_tarball())
 
         if maxsize > 0:
             size = os.path.getsize(debian_tar)
             if size > maxsize:
                 raise SourceTooLargeError(f"{debian_tar} is too large ({size} > {maxsize})")
 
-        with tarfile.open(debian_tar, 'r') as tar_f:
-            watchfile   = changelog   = None
-            watchfile_f = changelog_f = None
-
-            # Try to guess where the changelog and watch files are located.
-            # An absolute path (debian/XYZ) only works for non-native packages - native packages
-            # have an arbitrary prefix folder that we have to get around.
-            for member in tar_f.getmembers():
-                if extract_changelog and member.name.endswith("debian/changelog"):
-                    changelog_f = tar_f.extractfile(member)
-                elif extract_watchfile and member.name.endswith("debian/watch"):
-                    watchfile_f = tar_f.extractfile(member)
-
-            if changelog_f:
-                changelog = changelog_f.read()
-            if watchfile_f:
-                watchfile = watchfile_f.read()
-            return (changelog, watchfile)
+        wanted = set()
+        if extract_changelog:
+            wanted.add('changelog')
+        if extract_watchfile:
+            wanted.add('watch')
+        found = {}
+        if not wanted:
+            return (None, None)
+
+        # Read the tarball as a stream instead of indexing it with getmembers(), so that we can stop
+        # decompressing as soon as we have every file we need. This matters for native packages, where
+        # the tarball contains the entire upstream tree.
+        debian_dir = None
+        with tarfile.open(debian_tar, 'r|*') as tar_f:
+            for member in tar_f:
+                # Try to guess where the changelog and watch files are located.
+                # An absolute path (debian/XYZ) only works for non-native packages - native packages
+                # have an arbitrary prefix folder that we have to get around. Anything nested deeper than
+                # that is probably a vendored copy of some other package, so ignore it.
+                name = member.name.removeprefix('./').rstrip('/')
+                parts = name.split('/')
+                if debian_dir is not None and not name.startswith(debian_dir + '/'):
+                    # Tarballs list each directory's contents together, so once we've left the debian/
+                    # directory there is nothing more to find.
+                    break
+                if parts[-1] == 'debian' and len(parts) <= 2 and member.isdir():
+                    debian_dir = name
+                    continue
+                if len(parts) > 3 or len(parts) < 2 or parts[-2] != 'debian' or not member.isfile():
+                    continue
+                debian_dir = '/'.join(parts[:-1])
+                if parts[-1] in wanted and parts[-1] not in found:
+                    found[parts[-1]] = tar_f.extractfile(member).read()
+                    if len(found) == len(wanted):
+                        break
+
+        return (found.get('changelog'), found.get('watch'))
 
     def __repr__(self):
         return f'<PackageEntry object for {self.name}_{self.version}_{self.arch}>'
 
+class LRUCache(collections.OrderedDict):
+    """
+    Dict that evicts its least recently used entries once it holds more than maxsize. This supports the subset
+    of the shelve interface used by ExtractionCache and UscanCache, so it can be used as an in-memory backend.
+    """
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+class ExtractionCache():
+    """
+    Persistent on-disk cache of data extracted from source packages, so that unchanged sources
+    don't have to be decompressed again on every run.
+
+    Entries are keyed by PackageEntry.get_cache_key() and store only the pieces that were
+    actually extracted. When each entry was last used is tracked in a separate index, so that cache
+    hits don't rewrite the entries themselves. Entries that have not been used in max_age seconds
+    are pruned on sync and close, at most once every prune_interval seconds.
+    If path is None, entries are kept in memory only, up to memory_size of them.
+    """
+    _LAST_USED_KEY = '__last_used__'  # Mapping of entry keys to when they were last used
+    _LAST_PRUNED_KEY = '__last_pruned__'
+
+    def __init__(self, path, max_age, memory_size=None, prune_interval=86400):
+        self.persistent = bool(path)
+        self.db = shelve.open(path) if path else LRUCache(memory_size)
+        self.max_age = max_age
+        self.prune_interval = prune_interval
+        self.now = time.time()
+        self.last_used = self.db.get(self._LAST_USED_KEY, {}) if self.persistent else {}
+        self._last_used_changed = False
+
+    def _save_last_used(self):
+        if self.persistent and self._last_used_changed:
+            self.db[self._LAST_USED_KEY] = self.last_used
+            self._last_used_changed = False
+
+    def _touch(self, key):
+        # max_age is measured in days, so an hour's precision is plenty and saves rewriting the index on every hit
+        if self.persistent and self.now - self.last_used.get(key, 0) > 3600:
+            self.last_used[key] = self.now
+            self._last_used_changed = True
+
+    def sync(self):
+        """Writes pending changes to disk and updates the time used for expiry, for long-running processes."""
+        self.now = time.time()
+        self._prune_if_due()
+        self._save_last_used()
+        self.db.sync()
+
+    def get(self, key, extract_changelog=True, extract_watchfile=True):
+        """
+        Returns a cached (<changelog data>, <watch data>) tuple, or None if the requested pieces aren't cached.
+        """
+        data = self.db.get(key)
+        if data is None:
+            return None
+        if (extract_changelog and 'changelog' not in data) or (extract_watchfile and 'watchfile' not in data):
+            return None
+        self._touch(key)
+        return (data.get('changelog'), data.get('watchfile'))
+
+    def put(self, key, changelog=None, watchfile=None, extract_changelog=True, extract_watchfile=True):
+        """Stores extracted data for the given key, merging it with any existing entry."""
+        data = self.db.get(key, {})
+        if extract_changelog:
+            data['changelog'] = changelog
+        if extract_watchfile:
+            data['watchfile'] = watchfile
+        self.db[key] = data
+        self._touch(key)
+
+    def prune(self):
+        """Removes entries that have not been used in max_age seconds."""
+        for key in list(self.db.keys()):
+            if key in (self._LAST_USED_KEY, self._LAST_PRUNED_KEY):
+                continue
+            if key not in self.last_used:
+                # Entries from before last-used tracking get a fresh lease
+                self.last_used[key] = self.now
+            elif self.now - self.last_used[key] > self.max_age:
+                del self.db[key]
+                del self.last_used[key]
+        self._last_used_changed = True
+        self.db[self._LAST_PRUNED_KEY] = self.now
+
+    def _prune_if_due(self):
+        if self.persistent and self.max_age > 0 and \
+                self.now - self.db.get(self._LAST_PRUNED_KEY, 0) >= self.prune_interval:
+            self.prune()
+
+    def close(self):
+        self._prune_if_due()
+        self._save_last_used()
+        self.db.close()
+
+class UscanCache():
+    """
+    Persistent on-disk cache of uscan results, keyed by package name, upstream version and a hash
+    of the watch file. Entries expire after ttl seconds, and expired entries are removed on close,
+    and on sync at most once every prune_interval seconds.
+    If path is None, entries are kept in memory only, up to memory_size of them.
+    """
+    def __init__(self, path, ttl, refresh=False, memory_size=None, prune_interval=86400):
+        self.db = shelve.open(path) if path else LRUCache(memory_size)
+        self.ttl = ttl
+        self.refresh = refresh  # If set, ignore existing entries but still store new results
+        self.prune_interval = prune_interval
+        self.now = time.time()
+        self.last_pruned = self.now
+
+    def sync(self):
+        """Writes pending changes to disk and updates the time used for expiry, for long-running processes."""
+        self.now = time.time()
+        if self.now - self.last_pruned >= self.prune_interval:
+            self.prune()
+        self.db.sync()
+
+    @staticmethod
+    def get_key(name, upstream_version, watchfile):
+        watch_hash = hashlib.sha256(watchfile).hexdigest()
+        return f'{name}_{upstream_version}_{watch_hash}'
+
+    def get(self, key):
+        """Returns a cached (status, detected_upstream_version, upstream_url) tuple, or None if missing or expired."""
+        if self.refresh:
+            return None
+        data = self.db.get(key)
+        if data is None or self.now - data['time'] > self.ttl:
+            return None
+        return data['result']
+
+    def put(self, key, result):
+        self.db[key] = {'time': self.now, 'result': result}
+
+    def prune(self):
+        """Removes expired entries."""
+        for key in list(self.db.keys()):
+            if self.now - self.db[key]['time'] > self.ttl:
+                del self.db[key]
+        self.last_pruned = self.now
+
+    def close(self):
+        self.prune()
+        self.db.close()
+
 class AptlySourceType(enum.Enum):
     SNAPSHOT = 0
     REPO = 1
 
 class AptlyList():
-    def __init__(self, config_path):
+    def __init__(self, config_path, refresh_uscan=False, force=False, metrics=None, daemon=False):
         with open(config_path) as f:
             self.config = yaml.safe_load(f)
+        self.force = force
+        self.daemon = daemon
+        self.metrics = metrics or runmetrics.RunMetrics('aptlylist2')
+
+        # Changelog filenames referenced by each target rendered in this run
+        self.published_changelogs = collections.defaultdict(set)
+        self.extract_changelogs, self.run_uscan = self.check_extractor_options()
+
+        for fmt in self.config['html'].get('precompress', []):
+            if fmt == 'br' and brotli is None:
+                print('WARNING: brotli module not found, skipping .br output')
+            elif fmt not in ('gz', 'br'):
+                print(f'WARNING: unknown precompress format {fmt!r}')
+
+        # Persistent session so that connections to the aptly API are reused (this also supports http+unix:// URLs)
+        self.session = requests_unixsocket.Session()
+
+        # In daemon mode, package lists and extraction/uscan results are kept in memory between runs.
+        # The caches fall back to bounded in-memory storage if no persistent cache is configured.
+        daemon_opts = self.config.get('daemon', {})
+        self.package_lists = LRUCache(daemon_opts.get('max_package_lists', 16)) if daemon else None
+        self.state = None  # In-memory state manifest, used in daemon mode
+
+        self.extraction_cache = None
+        extractor_opts = self.config['extractors']
+        cache_path = extractor_opts.get('extraction_cache')
+        if cache_path or daemon:
+            max_age = extractor_opts.get('extraction_cache_max_age', 30) * 86400
+            self.extraction_cache = ExtractionCache(cache_path, max_age,
+                                                    memory_size=daemon_opts.get('max_extracted', 50000))
+
+        self.uscan_cache = None
+        cache_path = extractor_opts.get('uscan_cache')
+        if cache_path or daemon:
+            ttl = extractor_opts.get('uscan_cache_ttl', 24) * 3600
+            self.uscan_cache = UscanCache(cache_path, ttl, refresh=refresh_uscan,
+                                          memory_size=daemon_opts.get('max_uscan_results', 50000))
+
+    def extract_sources(self, packages, local_pool_dir, maxsize, extract_changelog=True, extract_watchfile=True):
+        """
+        Extracts metadata from all source packages in the given list of PackageEntry, consulting the
+        extraction cache when enabled. Tarballs are decompressed in a process pool if
+        extractors::extraction_workers is greater than 1.
+
+        Returns a dict mapping (name, version) to (<changelog data>, <watch data>). Packages that
+        failed extraction are reported and left out.
+        """
+        workers = self.config['extractors'].get('extraction_workers', 1)
+        extract_opts = {'extract_changelog': extract_changelog, 'extract_watchfile': extract_watchfile}
+        results = {}
+
+        def _report_error(entry, exc):
+            print(f'ERROR: failed to extract source tarball for package {entry.name} {entry.version}')
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+        def _store_result(entry, cache_key, result):
+            results[(entry.name, entry.version)] = result
+            if cache_key:
+                self.extraction_cache.put(cache_key, *result, **extract_opts)
+
+        to_extract = []
+        for entry in packages:
+            if entry.arch != 'source':
+                continue
+            cache_key = None
+            if self.extraction_cache:
+                try:
+                    cache_key = entry.get_cache_key(local_pool_dir)
+                except (OSError, SourceExtractionError) as e:
+                    _report_error(entry, e)
+                    continue
+                cached = self.extraction_cache.get(cache_key, **extract_opts)
+                if cached is not None:
+                    results[(entry.name, entry.version)] = cached
+                    continue
+            to_extract.append((entry, cache_key))
+
+        if workers > 1 and len(to_extract) > 1:
+            print(f'Extracting {len(to_extract)} source packages using {workers} workers')
+            # Targets are rendered while other threads are still fetching package lists, and forking a process
+            # with running threads can deadlock the child, so start workers from a forkserver instead
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        mp_context=multiprocessing.get_context('forkserver')) as executor:
+                futures = {
+                    executor.submit(entry.extract_metadata, local_pool_dir, maxsize, **extract_opts): (entry, cache_key)
+                    for entry, cache_key in to_extract
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    entry, cache_key = futures[future]
+                    try:
+                        result = future.result()
+                    except (tarfile.TarError, OSError, SourceExtractionError) as e:
+                        _report_error(entry, e)
+                    else:
+                        _store_result(entry, cache_key, result)
+        else:
+            for entry, cache_key in to_extract:
+                try:
+                    result = entry.extract_metadata(local_pool_dir, maxsize, **extract_opts)
+                except (tarfile.TarError, OSError, SourceExtractionError) as e:
+                    _report_error(entry, e)
+                else:
+                    _store_result(entry, cache_key, result)
+        return results
 
     def aptly_call(self, path):
         """Runs a GET request on aptly using the given path."""
         endpoint = self.config['api']['endpoint']
-        with requests_unixsocket.monkeypatch():
-            url = f'{endpoint}/{path}'
-            r = requests.get(url)
-            return r.json()
+        url = f'{endpoint}/{path}'
+        r = self.session.get(url)
+        return r.json()
+
+    def aptly_stream(self, path, stats=None):
+        """
+        Runs a GET request on aptly using the given path, and yields elements of the JSON array it
+        returns as they are received. If given, the amount of bytes received is added to stats.
+        """
+        endpoint = self.config['api']['endpoint']
+        url = f'{endpoint}/{path}'
+
+        def _count_chunks(chunks):
+            for chunk in chunks:
+                if stats:
+                    stats.add(nbytes=len(chunk))
+                yield chunk
+
+        with self.session.get(url, stream=True) as r:
+            r.raise_for_status()
+            yield from _iter_json_array(_count_chunks(r.iter_content(chunk_size=65536)))
 
     def check_uscan(self, name, version, watchfile):
         """
         Runs uscan with the given current package version and watchfile data.
 
-        Returns a tuple (status, detected_upstream_version, upstream_url) on success.
+        Returns a tuple (status, detected_upstream_version, upstream_url) on success. Any of these are
+        None if missing from uscan's output.
         """
         upstream_version = version.rsplit('-', 1)[0]
         uscan_output = subprocess.check_output([
@@ -166,19 +555,259 @@ class AptlyList():
 
         # Decode uscan output in XML (DEHS) format
         root = xml.etree.ElementTree.fromstring(uscan_output.decode('utf-8'))
-        status = root.find('status').text
-        upstream_ver = root.find('upstream-version').text
-        upstream_url = root.find('upstream-url').text
+        status = root.findtext('status')
+        upstream_ver = root.findtext('upstream-version')
+        upstream_url = root.findtext('upstream-url')
         print(f"  {name}_{version}: Got uscan data %r, %r, %r" % (status, upstream_ver, upstream_url))
         return (status, upstream_ver, upstream_url)
 
+    def check_uscan_all(self, packages, extracted):
+        """
+        Runs uscan for all source packages in the given list of PackageEntry, given a mapping of
+        (name, version) to extracted (<changelog data>, <watch data>) as returned by extract_sources.
+
+        Checks run concurrently, with at most extractors::uscan_workers checks in total and at most
+        extractors::uscan_host_limit checks per upstream host running at once.
+
+        Returns a dict mapping (name, version) to a tuple (status, detected_upstream_version, upstream_url).
+        """
+        extractor_opts = self.config['extractors']
+        workers = extractor_opts.get('uscan_workers', 1)
+        host_limit = extractor_opts.get('uscan_host_limit', 2)
+        results = {}
+        cache_keys = {}
+
+        # Group checks by the first upstream host mentioned in the watch file
+        checks_by_host = collections.defaultdict(list)
+        for entry in packages:
+            if entry.arch != 'source':
+                continue
+            key = (entry.name, entry.version)
+            _changelog, watchfile = extracted.get(key, (None, None))
+            if not watchfile:
+                # No watchfile was found.
+                status = _USCAN_PROBABLY_NATIVE if '-' not in entry.version else _USCAN_WATCH_FILE_NOT_FOUND
+                results[key] = (status, None, None)
+                continue
+            if self.uscan_cache:
+                cache_key = UscanCache.get_key(entry.name, entry.version.rsplit('-', 1)[0], watchfile)
+                cached = self.uscan_cache.get(cache_key)
+                if cached is not None:
+                    print(f"  {entry.name}_{entry.version}: Using cached uscan data %r, %r, %r" % cached)
+                    results[key] = cached
+                    continue
+                cache_keys[key] = cache_key
+            match = _USCAN_HOST_REGEX.search(watchfile.decode('utf-8', errors='replace'))
+            host = match.group(1).lower() if match else ''
+            checks_by_host[host].append((entry, watchfile))
+
+        def _run_checks(checks):
+            lane_results = {}
+            for entry, watchfile in checks:
+                try:
+                    status, upstream_version, url = self.check_uscan(entry.name, entry.version, watchfile)
+                except (subprocess.CalledProcessError, xml.etree.ElementTree.ParseError):
+                    status = None
+                if status is None:
+                    # uscan failed, or its output has no <status> (e.g. a DEHS error report)
+                    lane_results[(entry.name, entry.version)] = (_USCAN_FAILED, None, None)
+                else:
+                    lane_results[(entry.name, entry.version)] = (status.strip(), upstream_version, url)
+            return lane_results
+
+        # Split each host's checks into at most host_limit lanes that each run sequentially, so that
+        # a busy host never ties up more than host_limit workers.
+        lanes = []
+        for checks in checks_by_host.values():
+            lanes += [checks[i::host_limit] for i in range(min(host_limit, len(checks)))]
+        # Start with the longest lanes, since they determine the overall run time
+        lanes.sort(key=len, reverse=True)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for lane_results in executor.map(_run_checks, lanes):
+                results.update(lane_results)
+
+        for key, cache_key in cache_keys.items():
+            # Failures are not cached, since they are usually temporary
+            if results[key][0] != _USCAN_FAILED:
+                self.uscan_cache.put(cache_key, results[key])
+        return results
+
+    def get_output_filename(self, dist, component):
+        """Returns the output filename for the given distribution+component."""
+        # HACK: Mangle / in aptly prefixes to _
+        return self.config['html']['output_filename'].format(distribution=dist.replace('/', '_'), component=component)
+
+    @staticmethod
+    def get_shard_filename(filename, prefix):
+        """Returns the filename of the shard for the given package name prefix of a sharded output file."""
+        root, ext = os.path.splitext(filename)
+        return f'{root}.{prefix}{ext}'
+
+    @staticmethod
+    def _iter_table(table_header, rows):
+        yield table_header
+        yield from rows
+        yield '</table>'
+
+    def write_page(self, filename, title, body_parts, total_items):
+        """
+        Writes a HTML page with the given title and body (an iterable of strings) atomically, along with any
+        precompressed copies enabled in html::precompress. The page is streamed to disk and compressed from
+        there, so that it never has to be held in memory whole. Precompressed copies in formats that are no
+        longer enabled are removed. Returns the amount of bytes written.
+        """
+        html_opts     = self.config['html']
+        repo_name     = html_opts['repo_name']
+        extra_headers = html_opts.get('extra_headers', '')
+        curr_time     = time.strftime("%I:%M:%S %p, %b %d %Y +0000", time.gmtime())
+
+        tmp_filename = f'{filename}.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            f.write(f"""<!DOCTYPE HTML>
+<html>
+<head><title>Package List for {title} - {repo_name}</title>
+<meta charset="UTF-8">
+<meta name=viewport content="width=device-width">
+{extra_headers}
+</head>
+<body>
+<a href="/">Back to root</a>
+<br><br>
+""")
+            for part in body_parts:
+                f.write(part)
+            f.write(f"""
+<p><b>Total items:</b> {total_items}</p>
+<p>Last updated {curr_time}</p>
+</body>
+</html>""")
+        written_bytes = os.path.getsize(tmp_filename)
+
+        formats = set()
+        for fmt in html_opts.get('precompress', []):
+            if fmt == 'gz' or (fmt == 'br' and brotli):
+                formats.add(fmt)
+                written_bytes += self._compress_file(tmp_filename, f'{filename}.{fmt}', fmt)
+        os.replace(tmp_filename, filename)
+        for fmt in ('gz', 'br'):
+            if fmt not in formats and os.path.exists(f'{filename}.{fmt}'):
+                print(f'Removing {filename}.{fmt}, as {fmt} precompression is disabled')
+                os.remove(f'{filename}.{fmt}')
+        return written_bytes
+
+    @staticmethod
+    def _compress_file(filename, outfilename, fmt):
+        """Compresses a file with gzip or brotli in chunks, writing the result atomically. Returns the compressed size."""
+        tmp_filename = f'{outfilename}.tmp'
+        with open(filename, 'rb') as in_f, open(tmp_filename, 'wb') as out_f:
+            if fmt == 'gz':
+                with gzip.GzipFile(filename='', mode='wb', fileobj=out_f, compresslevel=9, mtime=0) as gz_f:
+                    shutil.copyfileobj(in_f, gz_f)
+            else:
+                compressor = brotli.Compressor()
+                while chunk := in_f.read(1 << 20):
+                    out_f.write(compressor.process(chunk))
+                out_f.write(compressor.finish())
+        os.replace(tmp_filename, outfilename)
+        return os.path.getsize(outfilename)
+
+    def publish_changelog(self, filename, data):
+        """
+        Writes a changelog file, unless it already exists with the same contents. Returns True if the file was changed.
+
+        Changelog filenames only include the source name and version, so a source published in several
+        distributions already shares one file.
+        """
+        try:
+            if os.path.getsize(filename) == len(data):
+                with open(filename, 'rb') as f:
+                    if f.read() == data:
+                        return False
+        except OSError:
+            pass
+        _write_file_atomic(filename, data)
+        return True
+
+    def prune_changelogs(self, known_dists, state):
+        """
+        Removes changelogs that are no longer referenced by any published target, given the published
+        (distribution, component) pairs and the state manifest. Pruning is skipped if the changelogs for
+        some published target are unknown (i.e. it was neither rendered in this run nor recorded in the state).
+        """
+        changelogs_dir = self.config['extractors']['changelogs_directory']
+        referenced = set()
+        for dist, component in known_dists:
+            target_name = f'{dist}/{component}'
+            if target_name in self.published_changelogs:
+                referenced |= self.published_changelogs[target_name]
+            elif 'changelogs' in state['targets'].get(target_name, {}):
+                referenced.update(state['targets'][target_name]['changelogs'])
+            else:
+                print(f'WARNING: changelogs for {target_name} are unknown, skipping changelog pruning')
+                return
+
+        with self.metrics.phase('prune') as stats:
+            for filename in os.listdir(changelogs_dir):
+                if filename.endswith('.changelog') and filename not in referenced:
+                    print(f'Removing unreferenced changelog {filename}')
+                    os.remove(os.path.join(changelogs_dir, filename))
+                    stats.add(items=1)
+
+    def get_source_state(self, source_type, source_name):
+        """
+        Returns a string identifying the current contents of a repo or snapshot. Snapshots are immutable,
+        so their name is enough, while local repos are fingerprinted using their package keys.
+        """
+        if source_type == AptlySourceType.SNAPSHOT:
+            return f'snapshot:{source_name}'
+        with self.metrics.phase('state', source_name) as stats:
+            package_keys = self.aptly_call(f'repos/{source_name}/packages')
+            stats.add(items=len(package_keys))
+        fingerprint = hashlib.sha256('\n'.join(sorted(package_keys)).encode()).hexdigest()
+        return f'repo:{source_name}:{fingerprint}'
+
+    def load_state(self):
+        """
+        Loads the state manifest from html::state_file, which maps targets to the state of their source
+        repo/snapshot when they were last rendered. Returns an empty manifest if it's disabled or missing.
+        """
+        if self.state is not None:
+            return self.state
+        state_file = self.config['html'].get('state_file')
+        # Changing the config (e.g. enabling changelogs) should regenerate everything
+        config_hash = hashlib.sha256(json.dumps(self.config, sort_keys=True).encode()).hexdigest()
+        state = {'config': config_hash, 'targets': {}}
+        if not state_file:
+            return state
+        try:
+            with open(state_file) as f:
+                old_state = json.load(f)
+        except (ValueError, OSError):
+            print(f'Failed to open state file {state_file}, ignoring')
+            return state
+        if old_state.get('config') == config_hash:
+            state['targets'] = old_state.get('targets', {})
+        return state
+
+    def save_state(self, state):
+        """Writes the state manifest to html::state_file, if set. In daemon mode, it is also kept in memory."""
+        if self.daemon:
+            self.state = state
+        state_file = self.config['html'].get('state_file')
+        if not state_file:
+            return
+        _write_file_atomic(state_file, json.dumps(state, indent=4).encode())
+
     def get_published_dists(self):
         """
         Return a mapping of published (distribution, component) pairs to their source repo/snapshot.
         """
         results = {}
 
-        data = self.aptly_call('publish')
+        with self.metrics.phase('publish') as stats:
+            data = self.aptly_call('publish')
+            stats.add(items=len(data))
         for entry in data:
             dist = entry['Distribution']
             # TODO: test this more fully
@@ -191,14 +820,16 @@ class AptlyList():
                 results[(dist, component)] = (source_type, source_name)
         return results
 
-    def get_packages(self, source_type, source_name, component):
+    def get_packages(self, source_type, source_name, component, stats=None):
         """
         Returns a list of PackageEntry representing the packages in the given source repo / snapshot.
+        If given, the amount of bytes received is added to stats (a runmetrics.PhaseStats).
         """
+        # Package details are parsed as they arrive; only the fields we render are kept
         if source_type == AptlySourceType.SNAPSHOT:
-            package_list = self.aptly_call(f'snapshots/{source_name}/packages?format=details')
+            package_list = self.aptly_stream(f'snapshots/{source_name}/packages?format=details', stats=stats)
         else:
-            package_list = self.aptly_call(f'repos/{source_name}/packages?format=details')
+            package_list = self.aptly_stream(f'repos/{source_name}/packages?format=details', stats=stats)
 
         results = []
         for package in package_list:
@@ -207,11 +838,19 @@ class AptlyList():
             if is_source:
                 # The Files field for a source package looks like the following:
                 # " 97fdc50df9688f7bfa5e108236cbded2 2080 numix-icon-theme-square_19.05.07-0utopia1.debian.tar.xz\n 0a87d8bf45f72f2bf1637c37ecb505c1 2114 numix-icon-theme-square_19.05.07-0utopia1.dsc\n 3b8e0e83ec5f40d034f6e752f527cdeb 1978947 numix-icon-theme-square_19.05.07.orig.tar.gz\n"
-                files = [file_entry.split()[-1] for file_entry in package['Files'].splitlines()]
+                files = []
+                checksums = {}
+                for file_entry in package['Files'].splitlines():
+                    if not file_entry.strip():
+                        continue
+                    md5sum, _size, filename = file_entry.split()
+                    files.append(filename)
+                    checksums[filename] = md5sum
                 source_name = name
                 description = None
             else:
                 files = [package['Filename']]
+                checksums = None
                 # aptly seems to only include the 'Source' field if binary package name != source
                 source_name = package.get('Source', name)
                 # Also some packages are formatted "source (version)" - we should remove the version tag
@@ -222,9 +861,10 @@ class AptlyList():
 
             entry = PackageEntry(
                 name=name,
-                architecture='source' if is_source else package['Architecture'],
+                # Intern values that repeat across many packages
+                architecture='source' if is_source else sys.intern(package['Architecture']),
                 version=package['Version'],
-                source_name=source_name,
+                source_name=sys.intern(source_name),
                 component=component,
                 description=description,
                 depends=package['Build-Depends'] if is_source else package.get('Depends'),
@@ -233,20 +873,18 @@ class AptlyList():
                 recommends=package.get('Recommends'),
                 suggests=package.get('Suggests'),
                 # Only set for source packages
-                vcs_browser=package.get('Vcs-Browser')
+                vcs_browser=package.get('Vcs-Browser'),
+                checksums=checksums
             )
             results.append(entry)
         return results
 
-    def write_package_list(self, dist, component, packages):
+    def check_extractor_options(self):
         """
-        Write a package list for the given distribution+component given a list of PackageEntry.
+        Returns a tuple (extract_changelogs, run_uscan) of the globally enabled extractors, disabling
+        any whose required options or tools are missing.
         """
         html_opts           = self.config['html']
-        repo_name           = html_opts['repo_name']
-        extra_headers       = html_opts.get('extra_headers', '')
-        output_filename     = html_opts['output_filename']
-        pool_root_url       = html_opts.get('pool_root_url')
         changelogs_root_url = html_opts.get('changelogs_root_url')
 
         extractor_opts      = self.config['extractors']
@@ -254,8 +892,6 @@ class AptlyList():
         run_uscan           = extractor_opts.get('uscan', False)
         changelogs_dir      = extractor_opts.get('changelogs_directory')
         local_pool_dir      = extractor_opts.get('local_pool_directory')
-        source_max_filesize = extractor_opts.get('source_max_filesize', 20971520)
-        uscan_dists         = extractor_opts.get('uscan_dists', [])
 
         if extract_changelogs:
             if not changelogs_root_url:
@@ -270,151 +906,208 @@ class AptlyList():
         if run_uscan and not shutil.which('uscan'):
             print('WARNING: uscan not found in path, disabling watchfile checking')
             run_uscan = False
-        elif uscan_dists and f'{dist}/{component}' not in uscan_dists:
-            # uscan_dists is set and uscan is not enabled for this target
-            run_uscan = False
 
-        should_extract_sources = extract_changelogs or run_uscan
-        if should_extract_sources and not local_pool_dir:
+        if (extract_changelogs or run_uscan) and not local_pool_dir:
             print('WARNING: local_pool_directory is not set, disabling source package extraction')
             extract_changelogs = run_uscan = False
+        return (extract_changelogs, run_uscan)
 
-        # HACK: Mangle / in aptly prefixes to _
-        filename = output_filename.format(distribution=dist.replace('/', '_'), component=component)
+    def get_extractor_options(self, dist, component):
+        """
+        Returns a tuple (extract_changelogs, run_uscan) for the given distribution+component.
+        """
+        uscan_dists = self.config['extractors'].get('uscan_dists', [])
+        run_uscan = self.run_uscan
+        if uscan_dists and f'{dist}/{component}' not in uscan_dists:
+            # uscan_dists is set and uscan is not enabled for this target
+            run_uscan = False
+        return (self.extract_changelogs, run_uscan)
+
+    def collect_metadata(self, packages, extract_changelogs, run_uscan, target=None):
+        """
+        Extracts source packages and runs uscan on them as needed, given a list of PackageEntry.
+        target is only used to label metrics.
+
+        Returns a tuple (extracted, uscan_results) of the results from extract_sources and check_uscan_all.
+        """
+        extractor_opts = self.config['extractors']
+        extracted = {}
+        if extract_changelogs or run_uscan:
+            with self.metrics.phase('extract', target) as stats:
+                extracted = self.extract_sources(
+                    packages,
+                    extractor_opts.get('local_pool_directory'),
+                    extractor_opts.get('source_max_filesize', 0),
+                    # Only extract the pieces we need to save time
+                    extract_changelog=extract_changelogs,
+                    extract_watchfile=run_uscan
+                )
+                stats.add(items=len(extracted),
+                          nbytes=sum(len(data) for result in extracted.values() for data in result if data))
+
+        uscan_results = {}
+        if run_uscan:
+            with self.metrics.phase('uscan', target) as stats:
+                uscan_results = self.check_uscan_all(packages, extracted)
+                stats.add(items=len(uscan_results))
+        return (extracted, uscan_results)
+
+    def write_package_list(self, dist, component, packages, metadata=None):
+        """
+        Write a package list for the given distribution+component given a list of PackageEntry.
+
+        metadata is an optional (extracted, uscan_results) tuple from collect_metadata, for sharing work between
+        targets publishing the same source. It is collected here if not given.
+
+        Returns the amount of bytes written to HTML output files.
+        """
+        html_opts           = self.config['html']
+        pool_root_url       = html_opts.get('pool_root_url')
+        changelogs_root_url = html_opts.get('changelogs_root_url')
+        changelogs_dir      = self.config['extractors'].get('changelogs_directory')
+
+        extract_changelogs, run_uscan = self.get_extractor_options(dist, component)
+
+        filename = self.get_output_filename(dist, component)
 
         packages.sort(key=lambda entry: entry.name)
 
-        with open(filename, 'w') as outf:
-            outf.write(f"""<!DOCTYPE HTML>
-<html>
-<head><title>Package List for {dist}/{component} - {repo_name}</title>
-<meta charset="UTF-8">
-<meta name=viewport content="width=device-width">
-{extra_headers}
-</head>
-<body>
-<a href="/">Back to root</a>
-<br><br>
-<table class="sortable">
+        if metadata is None:
+            metadata = self.collect_metadata(packages, extract_changelogs, run_uscan, target=f'{dist}/{component}')
+        extracted, uscan_results = metadata
+        if extract_changelogs:
+            self.published_changelogs[f'{dist}/{component}'] = set()
+
+        # Split large lists into shards by package name prefix, with the main file being an index page
+        shard_threshold = html_opts.get('shard_threshold', 0)
+        sharded = shard_threshold and len(packages) > shard_threshold
+
+        table_header = """<table class="sortable">
 <tr>
 <th>Package Name</th>
 <th>Version</th>
-<th>Architecture</th>""")
-            if extract_changelogs:
-                outf.write("""<th>Changelog</th>""")
-            if run_uscan:
-                outf.write("""<th>Watch Status</th>""")
-            outf.write("""<th>Vcs-Browser</th>
-<th>Package Relations</th>""")
+<th>Architecture</th>"""
+        if extract_changelogs:
+            table_header += """<th>Changelog</th>"""
+        if run_uscan:
+            table_header += """<th>Watch Status</th>"""
+        table_header += """<th>Vcs-Browser</th>
+<th>Package Relations</th>"""
 
-            for entry in packages:
-                # For the name field, include the first line of the package description as a tooltip if available
-                if entry.description:
-                    name_field = """<span title="{0} - {1}" class="tooltip">{0}</span>""".format(entry.name, html.escape(entry.description))
-                else:
-                    name_field = entry.name
+        def _render_row(entry):
+            row = []
+            # For the name field, include the first line of the package description as a tooltip if available
+            if entry.description:
+                name_field = """<span title="{0} - {1}" class="tooltip">{0}</span>""".format(entry.name, html.escape(entry.description))
+            else:
+                name_field = entry.name
 
-                # The architecture column will be a link pointing to the package file if resolving pool URLs is enabled
-                if pool_root_url:
-                    download_link = entry.get_download_url(pool_root_url)
-                    arch_field = f"""<a href="{download_link}">{entry.arch}</a>"""
-                else:
-                    arch_field = entry.arch
+            # The architecture column will be a link pointing to the package file if resolving pool URLs is enabled
+            if pool_root_url:
+                download_link = entry.get_download_url(pool_root_url)
+                arch_field = f"""<a href="{download_link}">{entry.arch}</a>"""
+            else:
+                arch_field = entry.arch
 
-                unique_id      = f"{entry.name}_{entry.version}"
-                unique_id_arch = f"{unique_id}_{entry.arch}"
-                # Name, version, architecture/download URL columns
-                outf.write(f"""<tr id="{unique_id_arch}">
+            unique_id      = f"{entry.name}_{entry.version}"
+            unique_id_arch = f"{unique_id}_{entry.arch}"
+            # Name, version, architecture/download URL columns
+            row.append(f"""<tr id="{unique_id_arch}">
 <td>{name_field}</td>
 <td>{entry.version}</td>
 <td>{arch_field}</td>
 """)
 
-                changelog = watchfile = None
-                if should_extract_sources and entry.arch == 'source':
-                    try:
-                        changelog, watchfile = entry.extract_metadata(
-                            local_pool_dir,
-                            source_max_filesize,
-                            # Only extract the pieces we need to save time
-                            extract_changelog=extract_changelogs,
-                            extract_watchfile=run_uscan
-                        )
-                    except (tarfile.TarError, OSError, SourceExtractionError):
-                        print(f'ERROR: failed to extract source tarball for package {entry.name} {entry.version}')
-                        traceback.print_exc()
-
-                # Changelog column
-                if extract_changelogs:
-                    if changelog and entry.arch == 'source':
-                        filename = f'{unique_id}.changelog'
-                        changelog_outname = os.path.join(changelogs_dir, filename)  # Full path on local disk
-
-                        with open(changelog_outname, 'wb') as changelog_outf:
-                            changelog_outf.write(changelog)
+            changelog, watchfile = extracted.get((entry.name, entry.version), (None, None))
+
+            # Changelog column
+            if extract_changelogs:
+                if changelog and entry.arch == 'source':
+                    changelog_filename = f'{unique_id}.changelog'
+                    changelog_outname = os.path.join(changelogs_dir, changelog_filename)  # Full path on local disk
 
+                    if self.publish_changelog(changelog_outname, changelog):
                         print(f'  {unique_id}: Extracted changelog to {changelog_outname}')
-                        changelog_url = f'{changelogs_root_url}/{filename}'
-                        outf.write(f"""<td><a href="{changelog_url}">Changelog</a></td>""")
-                    elif entry.arch != 'source':
-                        outf.write(f"""<td>See <a href="#{entry.source_name}_{entry.version}_source">source</a></td>""")
-                    else:
-                        outf.write("""<td>N/A</td>""")
-
-                # uscan / Watch Status column
-                if run_uscan:
-                    if entry.arch == 'source':  # This only exists for source packages
-                        url = upstream_version = None
-                        if not watchfile:
-                            # No watchfile was found.
-                            status = _USCAN_PROBABLY_NATIVE if '-' not in entry.version else _USCAN_WATCH_FILE_NOT_FOUND
-                        else:
-                            try:
-                                uscan_info = self.check_uscan(entry.name, entry.version, watchfile)
-                            except subprocess.CalledProcessError:
-                                status = _USCAN_FAILED
-                            else:
-                                status, upstream_version, url = uscan_info
-                                status = status.strip()
-
-                        # Prettify uscan format when applicable
-                        status_symbol = _USCAN_FORMAT.get(status)
-                        if status_symbol:
-                            status = f'{status_symbol} {status}'
-                        if url and upstream_version:
-                            outf.write(f"""<td>{status}<br>(<a href="{url}">{upstream_version}</a>)</td>""")
-                        else:
-                            outf.write(f"""<td>{status}</td>""")
-                    else:
-                        outf.write("""<td>N/A</td>""")
+                    self.published_changelogs[f'{dist}/{component}'].add(changelog_filename)
+                    changelog_url = f'{changelogs_root_url}/{changelog_filename}'
+                    row.append(f"""<td><a href="{changelog_url}">Changelog</a></td>""")
+                elif entry.arch != 'source':
+                    # The source package may be in a different shard
+                    source_page = ''
+                    if sharded:
+                        source_page = os.path.basename(self.get_shard_filename(filename, _get_pool_prefix(entry.source_name)))
+                    row.append(f"""<td>See <a href="{source_page}#{entry.source_name}_{entry.version}_source">source</a></td>""")
+                else:
+                    row.append("""<td>N/A</td>""")
 
-                # Vcs-Browser column
-                if entry.vcs_browser:
-                    outf.write(f"""<td><a href="{entry.vcs_browser}">{entry.vcs_browser}</a>""")
+            # uscan / Watch Status column
+            if run_uscan:
+                if entry.arch == 'source':  # This only exists for source packages
+                    status, upstream_version, url = uscan_results[(entry.name, entry.version)]
+
+                    # Prettify uscan format when applicable
+                    status_symbol = _USCAN_FORMAT.get(status)
+                    if status_symbol:
+                        status = f'{status_symbol} {status}'
+                    if url and upstream_version:
+                        row.append(f"""<td>{status}<br>(<a href="{url}">{upstream_version}</a>)</td>""")
+                    else:
+                        row.append(f"""<td>{status}</td>""")
                 else:
-                    outf.write("""<td>N/A</td>""")
-
-                # Package Relations column
-                dependency_text = ''
-                if entry.depends:
-                    heading = 'Build-Depends' if entry.arch == 'source' else 'Depends'
-                    dependency_text += f"""<span class="dependency deptype-depends">{heading}:</span> {html.escape(entry.depends)}<br>"""
-                if entry.recommends:
-                    heading = 'Recommends'
-                    dependency_text += f"""<span class="dependency deptype-recommends">{heading}:</span> {html.escape(entry.recommends)}<br>"""
-                if entry.suggests:
-                    heading = 'Suggests'
-                    dependency_text += f"""<span class="dependency deptype-suggests">{heading}:</span> {html.escape(entry.suggests)}<br>"""
-                outf.write(f"""<td>{dependency_text}</td>
+                    row.append("""<td>N/A</td>""")
+
+            # Vcs-Browser column
+            if entry.vcs_browser:
+                row.append(f"""<td><a href="{entry.vcs_browser}">{entry.vcs_browser}</a>""")
+            else:
+                row.append("""<td>N/A</td>""")
+
+            # Package Relations column
+            dependency_text = ''
+            if entry.depends:
+                heading = 'Build-Depends' if entry.arch == 'source' else 'Depends'
+                dependency_text += f"""<span class="dependency deptype-depends">{heading}:</span> {html.escape(entry.depends)}<br>"""
+            if entry.recommends:
+                heading = 'Recommends'
+                dependency_text += f"""<span class="dependency deptype-recommends">{heading}:</span> {html.escape(entry.recommends)}<br>"""
+            if entry.suggests:
+                heading = 'Suggests'
+                dependency_text += f"""<span class="dependency deptype-suggests">{heading}:</span> {html.escape(entry.suggests)}<br>"""
+            row.append(f"""<td>{dependency_text}</td>
 </tr>
 """)
+            return ''.join(row)
 
-            curr_time = time.strftime("%I:%M:%S %p, %b %d %Y +0000", time.gmtime())
-            outf.write(f"""</table>
-<p><b>Total items:</b> {len(packages)}</p>
-<p>Last updated {curr_time}</p>
-</body>
-</html>""")
+        title = f'{dist}/{component}'
+        written = set()
+        written_bytes = 0
+        # Rows are rendered as each page is written, so that only one row is held in memory at a time
+        if sharded:
+            shards = collections.defaultdict(list)
+            for entry in packages:
+                shards[_get_pool_prefix(entry.name)].append(entry)
+
+            index_links = []
+            for prefix, shard_entries in shards.items():
+                shard_filename = self.get_shard_filename(filename, prefix)
+                written_bytes += self.write_page(shard_filename, f'{title} ({prefix})',
+                                                 self._iter_table(table_header, map(_render_row, shard_entries)),
+                                                 len(shard_entries))
+                written.add(shard_filename)
+                index_links.append(f"""<li><a href="{os.path.basename(shard_filename)}">{prefix}</a> ({len(shard_entries)})</li>""")
+            written_bytes += self.write_page(filename, title, ['<ul class="shards">\n' + '\n'.join(index_links) + '\n</ul>'], len(packages))
+        else:
+            written_bytes += self.write_page(filename, title, self._iter_table(table_header, map(_render_row, packages)), len(packages))
+
+        # Remove shards left over from previous runs
+        root, ext = os.path.splitext(filename)
+        for old_filename in glob.glob(f'{glob.escape(root)}.*{glob.escape(ext)}'):
+            if old_filename not in written:
+                print(f'Removing old shard {old_filename}')
+                for suffix in ('', '.gz', '.br'):
+                    if os.path.exists(old_filename + suffix):
+                        os.remove(old_filename + suffix)
+        return written_bytes
 
     def process_targets(self, targets):
         """
@@ -422,10 +1115,12 @@ class AptlyList():
         If no targets are given, generate package lists for all published distributions.
         """
         known_dists = self.get_published_dists()
+        self.published_changelogs.clear()
 
         if not targets:
             targets = {'/'.join(pair) for pair in known_dists}
 
+        resolved_targets = []
         for target in targets:
             if '/' in target:
                 dist, component = target.rsplit('/', 1)
@@ -439,22 +1134,192 @@ class AptlyList():
                 print(f"ERROR: unknown distribution/component: {dist}/{component}")
                 continue
             else:
-                packages = self.get_packages(source_type, source_name, component)
-                self.write_package_list(dist, component, packages)
+                resolved_targets.append((dist, component, source_type, source_name))
+
+        # Skip targets whose source hasn't changed since they were last rendered. Lists are still regenerated
+        # every html::state_max_age hours so that time-dependent info (e.g. uscan status) stays fresh.
+        state = self.load_state()
+        if self.daemon:
+            self.state = state
+        max_age = self.config['html'].get('state_max_age', 24) * 3600
+        now = time.time()
+        target_states = {}
+        track_state = self.config['html'].get('state_file') or self.daemon
+        if track_state:
+            for dist, component, source_type, source_name in resolved_targets.copy():
+                target_name = f'{dist}/{component}'
+                target_state = target_states[(dist, component)] = self.get_source_state(source_type, source_name)
+                old_entry = state['targets'].get(target_name)
+                if self.force or not old_entry or old_entry['state'] != target_state:
+                    continue
+                if max_age > 0 and now - old_entry['time'] > max_age:
+                    continue
+                if not os.path.exists(self.get_output_filename(dist, component)):
+                    continue
+                print(f'Skipping unchanged target {target_name}')
+                resolved_targets.remove((dist, component, source_type, source_name))
+
+        # The same repo/snapshot is often published in several places, so only fetch and extract it once
+        groups = collections.defaultdict(list)
+        for dist, component, source_type, source_name in resolved_targets:
+            groups[(source_type, source_name, component)].append(dist)
+
+        def _fetch(source_type, source_name, component):
+            with self.metrics.phase('fetch', source_name) as stats:
+                packages = self.get_packages(source_type, source_name, component, stats=stats)
+                stats.add(items=len(packages))
+            return packages
+
+        def _render_group(group, packages):
+            component = group[2]
+            dists = groups[group]
+
+            # Collect everything that any target in the group needs
+            options = [self.get_extractor_options(dist, component) for dist in dists]
+            extract_changelogs = any(opt[0] for opt in options)
+            run_uscan = any(opt[1] for opt in options)
+            metadata = self.collect_metadata(packages, extract_changelogs, run_uscan, target=group[1])
+
+            for dist in dists:
+                with self.metrics.phase('render', f'{dist}/{component}') as stats:
+                    written_bytes = self.write_package_list(dist, component, packages, metadata=metadata)
+                    stats.add(items=len(packages), nbytes=written_bytes)
+
+                if track_state:
+                    state['targets'][f'{dist}/{component}'] = {
+                        'state': target_states[(dist, component)],
+                        'time': now,
+                        'changelogs': sorted(self.published_changelogs[f'{dist}/{component}']),
+                    }
+                    self.save_state(state)
 
                 # FOR DEBUGGING
                 #for pkg in packages:
-                #    print(json.dumps(pkg.__dict__))
+                #    print(json.dumps({attr: getattr(pkg, attr) for attr in pkg.__slots__}))
+
+        def _package_list_key(group):
+            # Package lists are only reused while their source is unchanged
+            return (group, target_states[(groups[group][0], group[2])])
+
+        # Reuse package lists kept in memory (in daemon mode)
+        to_fetch = []
+        for group in groups:
+            packages = self.package_lists.get(_package_list_key(group)) if self.package_lists is not None else None
+            if packages is not None:
+                print(f'Reusing package list for {group[1]}')
+                _render_group(group, packages)
+            else:
+                to_fetch.append(group)
+
+        # Fetch package lists concurrently, and render each target as soon as its package list arrives
+        workers = self.config['api'].get('workers', 4)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_fetch, source_type, source_name, component): (source_type, source_name, component)
+                for source_type, source_name, component in to_fetch
+            }
+            for future in concurrent.futures.as_completed(futures):
+                group = futures[future]
+                packages = future.result()
+                if self.package_lists is not None:
+                    self.package_lists[_package_list_key(group)] = packages
+                _render_group(group, packages)
+
+        if self.extract_changelogs and self.config['extractors'].get('prune_changelogs', False):
+            self.prune_changelogs(known_dists, state)
+
+    def run_daemon(self, targets, profile_output=None):
+        """
+        Runs process_targets in a loop, every daemon::interval seconds or as soon as a client connects to
+        the unix socket at daemon::socket. Only targets whose published source changed are regenerated;
+        a client can send "force" to regenerate all targets.
+
+        Metrics are written after each run and only cover that run. If profile_output is set, each run is
+        profiled, overwriting the profile of the previous one.
+        """
+        daemon_opts = self.config.get('daemon', {})
+        interval = daemon_opts.get('interval', 60)
+        socket_path = daemon_opts.get('socket')
+
+        server = None
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(socket_path)
+            server.listen()
+            print(f'Listening for triggers on {socket_path}')
+
+        try:
+            while True:
+                start = time.time()
+                self.metrics.reset()
+                try:
+                    runmetrics.run_profiled(lambda: self.process_targets(targets), profile_output)
+                except Exception:
+                    print('ERROR: failed to process targets')
+                    traceback.print_exc()
+                self.force = False
+                for cache in (self.extraction_cache, self.uscan_cache):
+                    if cache:
+                        cache.sync()
+                if self.uscan_cache:
+                    # --refresh-uscan only applies to the first run
+                    self.uscan_cache.refresh = False
+                self.metrics.finish()
+
+                # Wait until the next poll, or until we're triggered
+                while (timeout := start + interval - time.time()) > 0:
+                    if not server:
+                        time.sleep(timeout)
+                        break
+                    ready, _, _ = select.select([server], [], [], timeout)
+                    if ready:
+                        conn, _ = server.accept()
+                        with conn:
+                            conn.settimeout(5)
+                            try:
+                                command = conn.recv(64).decode('utf-8', errors='replace').strip()
+                                conn.sendall(b'ok\n')
+                            except OSError:
+                                command = ''
+                        print(f'Triggered over socket (command: {command!r})')
+                        self.force = command == 'force'
+                        break
+        finally:
+            if server:
+                server.close()
+                os.remove(socket_path)
+
+    def close(self):
+        """Flushes any persistent caches to disk and closes the aptly API session."""
+        self.session.close()
+        if self.extraction_cache:
+            self.extraction_cache.close()
+        if self.uscan_cache:
+            self.uscan_cache.close()
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     #parser.add_argument("-V", "--version", action='version', version=f'aptlylist {__version__}')
     parser.add_argument("-c", "--config", type=str, help=f'path to config file (defaults to aptlylist2.yaml)', default='aptlylist2.yaml')
+    parser.add_argument("-f", "--force", action='store_true', help='regenerate all targets, even if their source repo/snapshot is unchanged')
+    parser.add_argument("-d", "--daemon", action='store_true', help='keep running and regenerate lists whenever their published source changes (see the daemon section of the config)')
+    parser.add_argument("--refresh-uscan", action='store_true', help='ignore cached uscan results and check all watch files again')
+    runmetrics.add_arguments(parser)
     parser.add_argument("targets", nargs='*', help='targets to process, in the form "distribution" or "distribution/component". if no targets are given, process all published distributions in aptly')
     args = parser.parse_args()
 
-    list_engine = AptlyList(args.config)
-    list_engine.process_targets(args.targets)
+    metrics = runmetrics.RunMetrics.from_args('aptlylist2', args)
+    list_engine = AptlyList(args.config, refresh_uscan=args.refresh_uscan, force=args.force, metrics=metrics, daemon=args.daemon)
+    try:
+        if args.daemon:
+            list_engine.run_daemon(args.targets, profile_output=args.profile)
+        else:
+            runmetrics.run_profiled(lambda: list_engine.process_targets(args.targets), args.profile)
+    finally:
+        list_engine.close()
+        metrics.finish()
 
 if __name__ == '__main__':
     main()
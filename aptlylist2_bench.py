@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for aptlylist2.py.
+
+This generates a synthetic pool of source packages, serves matching package lists from a fake
+aptly API over a unix socket, and times AptlyList.process_targets end to end and per phase.
+"""
+import argparse
+import http.server
+import io
+import json
+import os
+import random
+import socketserver
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import yaml
+
+import aptlylist2
+
+_WATCH_HOSTS = ['github.com', 'pypi.debian.net', 'gitlab.com', 'download.gnome.org', 'sourceforge.net']
+
+def _add_tar_file(tar_f, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar_f.addfile(info, io.BytesIO(data))
+
+def generate_pool(pool_dir, count, tarball_size, native_ratio, binaries_per_source, seed=0):
+    """
+    Generates synthetic source tarballs under pool_dir/main, and returns a list of aptly package
+    details dicts (in format=details form) describing them.
+    """
+    rand = random.Random(seed)
+    packages = []
+    for i in range(count):
+        # Mix in some lib* packages so that pool prefixes and shards get exercised
+        name = f'lib{rand.choice("abcdefgh")}bench{i}' if i % 4 == 0 else f'{rand.choice("abcdefghijklmnop")}bench{i}'
+        native = rand.random() < native_ratio
+        upstream_version = f'{rand.randint(0, 9)}.{rand.randint(0, 99)}'
+        version = upstream_version if native else f'{upstream_version}-1'
+        prefix = aptlylist2._get_pool_prefix(name)
+        package_dir = os.path.join(pool_dir, 'main', prefix, name)
+        os.makedirs(package_dir, exist_ok=True)
+
+        changelog = f'{name} ({version}) unstable; urgency=medium\n\n  * Synthetic benchmark package.\n\n -- Bench <bench@example.org>  Thu, 01 Jan 2026 00:00:00 +0000\n'
+        host = rand.choice(_WATCH_HOSTS)
+        watchfile = f'version=4\nhttps://{host}/example/{name}/tags .*/v?(\\d\\S+)\\.tar\\.gz\n'
+
+        if native:
+            tarball = f'{name}_{version}.tar.xz'
+            tar_prefix = f'{name}-{version}/'
+        else:
+            tarball = f'{name}_{version}.debian.tar.xz'
+            tar_prefix = ''
+        with tarfile.open(os.path.join(package_dir, tarball), 'w:xz') as tar_f:
+            if native and tarball_size:
+                # Put upstream sources before debian/ as a worst case for scanning. Random data is
+                # used so that the tarball is actually about tarball_size bytes after compression.
+                _add_tar_file(tar_f, f'{tar_prefix}src/data.bin', rand.randbytes(tarball_size))
+            _add_tar_file(tar_f, f'{tar_prefix}debian/changelog', changelog.encode())
+            if not native:
+                _add_tar_file(tar_f, f'{tar_prefix}debian/watch', watchfile.encode())
+        tarball_path = os.path.join(package_dir, tarball)
+
+        binaries = [f'{name}-bin{j}' if j else name for j in range(binaries_per_source)]
+        files = [f' 00000000000000000000000000000000 100 {name}_{version}.dsc',
+                 f' {rand.randbytes(16).hex()} {os.path.getsize(tarball_path)} {tarball}']
+        packages.append({
+            'Package': name,
+            'Version': version,
+            'Architecture': 'source',
+            'Binary': ', '.join(binaries),
+            'Build-Depends': 'debhelper-compat (= 13)',
+            'Files': '\n'.join(files) + '\n',
+            'Vcs-Browser': f'https://{host}/example/{name}',
+        })
+        for binary in binaries:
+            package = {
+                'Package': binary,
+                'Version': version,
+                'Architecture': 'amd64',
+                'Filename': f'{binary}_{version}_amd64.deb',
+                'Description': f'synthetic benchmark package {binary}\n Long description.',
+                'Depends': 'libc6 (>= 2.36)',
+            }
+            if binary != name:
+                package['Source'] = name
+            packages.append(package)
+    return packages
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class FakeAptlyHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the subset of the aptly API used by aptlylist2 from the server's publish_data and snapshots."""
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        if parts == ['api', 'publish']:
+            return self._send_json(self.server.publish_data)
+        if len(parts) == 4 and parts[0] == 'api' and parts[1] in ('snapshots', 'repos') and parts[3] == 'packages':
+            packages = self.server.snapshots.get(parts[2])
+            if packages is None:
+                return self._send_json({'error': 'not found'}, status=404)
+            if query.get('format') == ['details']:
+                return self._send_json(packages)
+            keys = [f"P{pkg['Architecture']} {pkg['Package']} {pkg['Version']} 0" for pkg in packages]
+            return self._send_json(keys)
+        self._send_json({'error': 'not found'}, status=404)
+
+def start_fake_aptly(socket_path, publish_data, snapshots):
+    """Starts a fake aptly API server on the given unix socket in a background thread."""
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = _UnixHTTPServer(socket_path, FakeAptlyHandler)
+    server.publish_data = publish_data
+    server.snapshots = snapshots
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def summarize_phases(summary):
+    """Sums a RunMetrics summary's per-target stats for each phase."""
+    phases = {}
+    for entry in summary['phases']:
+        totals = phases.setdefault(entry['phase'], {'seconds': 0.0, 'calls': 0, 'items': 0, 'bytes': 0})
+        for key in totals:
+            totals[key] += entry[key]
+    return phases
+
+def run_benchmark(config_path, runs, force, uscan_latency):
+    """Runs AptlyList.process_targets the given number of times, returning the metrics summary of each run."""
+    results = []
+    for run in range(runs):
+        list_engine = aptlylist2.AptlyList(config_path, force=force)
+        if uscan_latency is not None:
+            # Simulate uscan network requests instead of running it
+            def _fake_check_uscan(name, version, watchfile):
+                time.sleep(uscan_latency)
+                return ('up to date', version.rsplit('-', 1)[0], f'https://example.org/{name}')
+            list_engine.check_uscan = _fake_check_uscan
+            list_engine.run_uscan = True
+        try:
+            list_engine.process_targets([])
+        finally:
+            list_engine.close()
+        results.append(list_engine.metrics.summary())
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-d", "--workdir", help="directory for the synthetic pool, caches and output (defaults to a new temporary directory)")
+    parser.add_argument("-n", "--sources", help="number of source packages to generate", type=int, default=500)
+    parser.add_argument("-b", "--binaries", help="number of binary packages per source", type=int, default=2)
+    parser.add_argument("--native-ratio", help="fraction of source packages that are native", type=float, default=0.2)
+    parser.add_argument("--tarball-size", help="size of upstream data in native tarballs, in bytes", type=int, default=65536)
+    parser.add_argument("--publish-points", help="number of distributions publishing the same snapshot", type=int, default=3)
+    parser.add_argument("--extraction-workers", type=int, default=1)
+    parser.add_argument("--uscan-workers", type=int, default=1)
+    parser.add_argument("--uscan-latency", help="simulate uscan checks taking this many seconds (disables uscan if not set)", type=float)
+    parser.add_argument("--cache", help="enable the extraction and uscan caches", action='store_true')
+    parser.add_argument("--state", help="enable the state file, so that runs after the first are incremental", action='store_true')
+    parser.add_argument("--shard-threshold", type=int, default=0)
+    parser.add_argument("-r", "--runs", help="number of times to run process_targets (to measure warm caches)", type=int, default=1)
+    parser.add_argument("-o", "--output", help="write timings as JSON to this file")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='aptlylist2-bench-')
+    pool_dir = os.path.join(workdir, 'pool')
+    print(f'Using {workdir} as workdir')
+
+    gen_start = time.perf_counter()
+    packages = generate_pool(pool_dir, args.sources, args.tarball_size, args.native_ratio, args.binaries)
+    print(f'Generated {args.sources} source packages ({len(packages)} entries) in {time.perf_counter() - gen_start:.2f}s')
+
+    publish_data = [{
+        'Distribution': f'bench{i}',
+        'Prefix': '.',
+        'SourceKind': 'snapshot',
+        'Sources': [{'Component': 'main', 'Name': 'bench-snapshot'}],
+    } for i in range(args.publish_points)]
+    socket_path = os.path.join(workdir, 'aptly.sock')
+    server = start_fake_aptly(socket_path, publish_data, {'bench-snapshot': packages})
+
+    config = {
+        'api': {'endpoint': f"http+unix://{urllib.parse.quote(socket_path, safe='')}/api"},
+        'extractors': {
+            'changelogs': True,
+            'changelogs_directory': os.path.join(workdir, 'changelogs'),
+            'local_pool_directory': pool_dir,
+            'extraction_workers': args.extraction_workers,
+            'uscan': False,
+            'uscan_workers': args.uscan_workers,
+        },
+        'html': {
+            'repo_name': 'Benchmark',
+            'pool_root_url': 'https://example.org/pool',
+            'changelogs_root_url': 'https://example.org/changelogs',
+            'output_filename': os.path.join(workdir, 'out', '{distribution}_{component}_list.html'),
+            'shard_threshold': args.shard_threshold,
+        },
+    }
+    if args.cache:
+        config['extractors']['extraction_cache'] = os.path.join(workdir, 'extract.cache')
+        config['extractors']['uscan_cache'] = os.path.join(workdir, 'uscan.cache')
+    if args.state:
+        config['html']['state_file'] = os.path.join(workdir, 'state.json')
+    os.makedirs(os.path.join(workdir, 'out'), exist_ok=True)
+    config_path = os.path.join(workdir, 'aptlylist2-bench.yaml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f)
+
+    try:
+        results = run_benchmark(config_path, args.runs, force=not args.state, uscan_latency=args.uscan_latency)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print()
+    for i, summary in enumerate(results):
+        print(f'Run {i + 1}:')
+        for phase, totals in summarize_phases(summary).items():
+            print(f"  {phase:20} {totals['seconds']:8.3f}s {totals['calls']:6} calls {totals['items']:8} items {totals['bytes']:12} bytes")
+        print(f"  {'total':20} {summary['seconds']:8.3f}s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'runs': results}, f, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,221 @@
 #!/usr/bin/env python3
 from collections import defaultdict
+import concurrent.futures
+import functools
+import os
+import string
 import sys
-import subprocess
+import threading
 import time
 
+import requests
+import requests_unixsocket
+
+# Aptly API endpoint. Unix sockets can be used using the http+unix URI and escaping /'s in the filename as %2F
+API_ENDPOINT = os.environ.get('APTLY_API_ENDPOINT', 'http+unix://%2Fsrv%2Faptly%2Faptly.sock/api')
+
+# One session is shared by all requests, so that the connection to aptly is reused
+session = requests_unixsocket.Session()
+
+# How often to poll aptly for the output of running tasks, in seconds. The interval doubles after each
+# poll up to TASK_MAX_POLL_INTERVAL, as aptly returns a task's whole output every time.
+TASK_POLL_INTERVAL = 1
+TASK_MAX_POLL_INTERVAL = 30
+
+class AptlyError(Exception):
+    pass
+
 def _error():
-    print("error: unknown command, valid commands are 'getdup', 'msnapshot',"
-          " 'refreshmirrors', 'purge', 'rsnapshot'")
+    print("error: unknown command, valid commands are 'getdup [--remove] [REPO ...]', 'msnapshot',"
+          " 'refreshmirrors [-j JOBS] [MIRROR ...]', 'purge', 'rsnapshot'")
     sys.exit(1)
 
-def getdups(reponame):
-    if reponame not in repos:
+def aptly_call(method, path, **kwargs):
+    """Runs a request on the aptly API using the given path, returning the decoded JSON response."""
+    r = session.request(method, f'{API_ENDPOINT}/{path}', **kwargs)
+    try:
+        data = r.json()
+    except ValueError:
+        data = None
+    if not r.ok:
+        error = data.get('error') if isinstance(data, dict) else None
+        if isinstance(data, list) and data:
+            error = data[0].get('error')
+        raise AptlyError(error or f'{method} {path} failed with HTTP {r.status_code}')
+    return data
+
+def start_task(method, path, **kwargs):
+    """Starts an aptly API call as a background task, returning the task ID (or None if aptly ran it synchronously)."""
+    data = aptly_call(method, path, params={'_async': 'true'}, **kwargs)
+    if isinstance(data, dict) and 'State' in data and 'ID' in data:
+        return data['ID']
+    return None
+
+def _finish_task(task_id, task, output):
+    aptly_call('DELETE', f'tasks/{task_id}')
+    if task.get('State') == 3:  # FAILED
+        raise AptlyError(output.strip().splitlines()[-1].removeprefix('ERROR: ') if output.strip() else f'task {task_id} failed')
+
+def wait_task(task_id):
+    """Waits for an aptly task to finish, returning its output. Raises AptlyError if the task failed."""
+    if task_id is None:
+        return ''
+    task = aptly_call('GET', f'tasks/{task_id}/wait')
+    output = aptly_call('GET', f'tasks/{task_id}/output') or ''
+    _finish_task(task_id, task, output)
+    return output
+
+def follow_task(task_id, write):
+    """
+    Waits for an aptly task to finish, passing each complete line of its output to write() as it arrives.
+    Raises AptlyError if the task failed.
+
+    aptly can't return only new output, so every poll fetches all output so far. Polls back off to
+    TASK_MAX_POLL_INTERVAL to limit how often the output of long tasks (e.g. mirror updates) is
+    transferred again, at the cost of it arriving in larger batches.
+    """
+    if task_id is None:
+        return
+    written = 0
+    interval = TASK_POLL_INTERVAL
+    while True:
+        task = aptly_call('GET', f'tasks/{task_id}')
+        output = aptly_call('GET', f'tasks/{task_id}/output') or ''
+        done = task.get('State') in (2, 3)  # SUCCEEDED, FAILED
+        # Only write complete lines until the task is done
+        end = len(output) if done else output.rfind('\n', written) + 1
+        for line in output[written:end].splitlines(keepends=True):
+            write(line)
+        written = max(written, end)
+        if done:
+            break
+        time.sleep(interval)
+        interval = min(interval * 2, TASK_MAX_POLL_INTERVAL)
+    _finish_task(task_id, task, output)
+
+# Lists are only fetched from aptly when a command needs them
+@functools.cache
+def get_repos():
+    return [repo['Name'] for repo in aptly_call('GET', 'repos')]
+
+@functools.cache
+def get_mirrors():
+    return [mirror['Name'] for mirror in aptly_call('GET', 'mirrors')]
+
+@functools.cache
+def get_snapshots():
+    return {snapshot['Name'] for snapshot in aptly_call('GET', 'snapshots')}
+
+def _parse_package_key(key):
+    """Splits an aptly package key ("Parch name version hash") into its name, version and architecture."""
+    arch, name, version, _hash = key.split(' ', 3)
+    return name, version, arch[1:]
+
+def _check_repo(reponame):
+    if reponame not in get_repos():
         print("error: repo '%s' does not exist!" % reponame)
         sys.exit(2)
-    else:
+
+def _version_order(c):
+    if not c or c in string.digits:
+        return 0
+    if c in string.ascii_letters:
+        return ord(c)
+    if c == '~':
+        return -1
+    return ord(c) + 256
+
+def _verrevcmp(a, b):
+    """Compares two upstream versions or Debian revisions, like dpkg's verrevcmp()."""
+    i = j = 0
+    while i < len(a) or j < len(b):
+        first_diff = 0
+        while (i < len(a) and a[i] not in string.digits) or (j < len(b) and b[j] not in string.digits):
+            ac = _version_order(a[i:i+1])
+            bc = _version_order(b[j:j+1])
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while a[i:i+1] == '0':
+            i += 1
+        while b[j:j+1] == '0':
+            j += 1
+        while a[i:i+1] and a[i] in string.digits and b[j:j+1] and b[j] in string.digits:
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if a[i:i+1] and a[i] in string.digits:
+            return 1
+        if b[j:j+1] and b[j] in string.digits:
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+def _split_version(version):
+    # The epoch ends at the first colon, and the revision starts after the last hyphen
+    epoch, _, rest = version.partition(':') if ':' in version else ('0', '', version)
+    upstream, _, revision = rest.rpartition('-') if '-' in rest else (rest, '', '')
+    return int(epoch or 0), upstream, revision
+
+def compare_versions(a, b):
+    """Compares two Debian package versions, returning a negative, zero or positive number like dpkg --compare-versions."""
+    a_epoch, a_upstream, a_revision = _split_version(a)
+    b_epoch, b_upstream, b_revision = _split_version(b)
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+    return _verrevcmp(a_upstream, b_upstream) or _verrevcmp(a_revision, b_revision)
+
+def find_duplicates(reponames):
+    """
+    Scans the packages of the given repos, returning a dict mapping each repo to a list of
+    (name, architecture, [(version, key), ...]) for packages with more than one version in that repo.
+    Versions are sorted from newest to oldest.
+    """
+    version_key = functools.cmp_to_key(compare_versions)
+    results = {}
+    for reponame in reponames:
+        packages = defaultdict(list)
+        for key in aptly_call('GET', f'repos/{reponame}/packages'):
+            name, version, arch = _parse_package_key(key)
+            packages[(name, arch)].append((version, key))
+        results[reponame] = [
+            (name, arch, sorted(versions, key=lambda v: version_key(v[0]), reverse=True))
+            for (name, arch), versions in sorted(packages.items()) if len(versions) > 1
+        ]
+    return results
+
+def getdups(reponames, remove=False):
+    """
+    Prints packages with more than one version in each of the given repos. If remove is set, older
+    versions are removed, using one aptly call per repo.
+    """
+    for reponame in reponames:
+        _check_repo(reponame)
+    for reponame, duplicates in find_duplicates(reponames).items():
         print('checking duplicates for repo %s...' % reponame)
-        showpackages = subprocess.check_output(['aptly', 'repo', 'show', '-with-packages', reponame]).decode('utf-8').split("\n")
-        uniqPackages = defaultdict(set)
-        for p in showpackages:
-            p = p.split("_")
-            if len(p) == 3:
-                packageName, version = p[0].strip(), p[1]
-                uniqPackages[packageName].add(version)
-        for p, v in uniqPackages.items():
-            if len(v) > 1:
-                print('Duplicate package: %s (%s)' % (p, ', '.join(v)))
+        old_keys = []
+        for name, arch, versions in duplicates:
+            print('Duplicate package: %s [%s] (%s)' % (name, arch, ', '.join(version for version, _key in versions)))
+            old_keys += [key for _version, key in versions[1:]]
+        if remove and old_keys:
+            aptly_call('DELETE', f'repos/{reponame}/packages', json={'PackageRefs': old_keys})
+            for key in old_keys:
+                print('[-] %s_%s_%s removed' % _parse_package_key(key))
 
 def purge(reponame, packages):
-    if reponame not in repos:
-        print("error: repo '%s' does not exist!" % reponame)
-        sys.exit(2)
+    _check_repo(reponame)
     s = ['{0} | $Source ({0})'.format(p) for p in packages]
     s = ' | '.join(s)
     if s:
-        sys.stdout.write(subprocess.check_output(['aptly', 'repo', 'remove', reponame, s]).decode('utf-8'))
+        print('Loading packages...')
+        keys = aptly_call('GET', f'repos/{reponame}/packages', params={'q': s})
+        if keys:
+            aptly_call('DELETE', f'repos/{reponame}/packages', json={'PackageRefs': keys})
+        for key in keys:
+            print('[-] %s_%s_%s removed' % _parse_package_key(key))
     else:
         print('no matching packages')
         sys.exit(3)
@@ -43,43 +225,115 @@ def _get_snapshot_name(src):
     snapshot_name = base_snapshot_name = '%s-%s' % (src, date)
     c = 0
     # Increment to reponame-date+X on snapshot name collision
-    while snapshot_name in existing_snapshots:
+    while snapshot_name in get_snapshots():
         c += 1
         snapshot_name = "%s+%s" % (base_snapshot_name, c)
+    # Reserve the name for any other snapshots created in this run
+    get_snapshots().add(snapshot_name)
     return snapshot_name
 
-try:
-    command = sys.argv[1].lower()
-except IndexError:
-    _error()
-params = sys.argv[2:]
-repos = subprocess.check_output(['aptly', 'repo', 'list', '-raw']).decode('utf-8').splitlines()
-mirrors = subprocess.check_output(['aptly', 'mirror', 'list', '-raw']).decode('utf-8').splitlines()
-existing_snapshots = subprocess.check_output(['aptly', 'snapshot', 'list', '-raw']).decode('utf-8').splitlines()
-
-if command == 'getdup':
-    if len(sys.argv) < 3:
-        print('error: needs repo name!')
-        sys.exit(2)
-    getdups(params[0])
-elif command == 'msnapshot':
-    mirrors = params or mirrors
-    for mir in mirrors:
-        snapshot_name = base_snapshot_name = '%s-%s' % (repo, date)
-        sys.stdout.write(subprocess.check_output(['aptly', 'snapshot', 'create', _get_snapshot_name(mir), 'from', 'mirror', mir]).decode('utf-8'))
-
-elif command == 'rsnapshot':
-    repos = params or repos
-    for repo in repos:
-        sys.stdout.write(subprocess.check_output(['aptly', 'snapshot', 'create', _get_snapshot_name(repo), 'from', 'repo', repo]).decode('utf-8'))
-
-elif command == 'refreshmirrors':
-    for m in mirrors:
-        sys.stdout.write(subprocess.check_output(['aptly', 'mirror', 'update', m]).decode('utf-8'))
-elif command == 'purge':
-    if len(sys.argv) < 3:
-        print('error: needs repo name!')
-        sys.exit(2)
-    purge(params[0], params[1:])
-else:
-    _error()
+def create_snapshots(kind, sources):
+    """
+    Creates snapshots of the given repos or mirrors (kind is 'repos' or 'mirrors'). All snapshots are
+    submitted to aptly as tasks at once, and then waited for in order.
+    """
+    tasks = []
+    for src in sources:
+        snapshot_name = _get_snapshot_name(src)
+        tasks.append((snapshot_name, start_task('POST', f'{kind}/{src}/snapshots', json={'Name': snapshot_name})))
+    for snapshot_name, task_id in tasks:
+        wait_task(task_id)
+        sys.stdout.write("\nSnapshot %s successfully created.\n"
+                         "You can run 'aptly publish snapshot %s' to publish snapshot as Debian repository.\n"
+                         % (snapshot_name, snapshot_name))
+
+def refresh_mirrors(mirrors, jobs=1):
+    """
+    Updates mirrors, running up to jobs updates at once. Output is written as it arrives (prefixed with
+    the mirror name when running in parallel), and a failing mirror doesn't stop the others from updating.
+    Returns a dict of mirror names to error messages (or None on success).
+    """
+    output_lock = threading.Lock()
+
+    def _update(mirror):
+        def _write(line):
+            with output_lock:
+                if jobs > 1:
+                    line = '[%s] %s' % (mirror, line)
+                sys.stdout.write(line if line.endswith('\n') else line + '\n')
+                sys.stdout.flush()
+        follow_task(start_task('PUT', f'mirrors/{mirror}', json={}), _write)
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_update, mirror): mirror for mirror in mirrors}
+        for future in concurrent.futures.as_completed(futures):
+            mirror = futures[future]
+            try:
+                future.result()
+                results[mirror] = None
+            except (AptlyError, requests.exceptions.RequestException) as e:
+                # e.g. the connection to aptly was reset while following this mirror's task
+                results[mirror] = str(e)
+                with output_lock:
+                    print('error: updating mirror %s failed: %s' % (mirror, e))
+    return results
+
+def _parse_jobs(params):
+    """Parses a -j JOBS / -jJOBS option out of params, returning (jobs, remaining params)."""
+    jobs = 1
+    remaining = []
+    params = iter(params)
+    for param in params:
+        if param.startswith('-j'):
+            value = param[2:] or next(params, '')
+            try:
+                jobs = int(value)
+            except ValueError:
+                print("error: invalid number of jobs '%s'" % value)
+                sys.exit(2)
+            if jobs < 1:
+                print('error: number of jobs must be at least 1')
+                sys.exit(2)
+        else:
+            remaining.append(param)
+    return jobs, remaining
+
+def main():
+    try:
+        command = sys.argv[1].lower()
+    except IndexError:
+        _error()
+    params = sys.argv[2:]
+
+    try:
+        if command == 'getdup':
+            remove = '--remove' in params
+            reponames = [param for param in params if param != '--remove']
+            getdups(reponames or get_repos(), remove=remove)
+        elif command == 'msnapshot':
+            create_snapshots('mirrors', params or get_mirrors())
+
+        elif command == 'rsnapshot':
+            create_snapshots('repos', params or get_repos())
+
+        elif command == 'refreshmirrors':
+            jobs, mirrors = _parse_jobs(params)
+            results = refresh_mirrors(mirrors or get_mirrors(), jobs=jobs)
+            failed = [m for m, error in results.items() if error]
+            if failed:
+                print('%d of %d mirrors failed to update: %s' % (len(failed), len(results), ', '.join(sorted(failed))))
+                sys.exit(1)
+        elif command == 'purge':
+            if len(sys.argv) < 3:
+                print('error: needs repo name!')
+                sys.exit(2)
+            purge(params[0], params[1:])
+        else:
+            _error()
+    except (AptlyError, requests.exceptions.RequestException) as e:
+        print('error: %s' % e)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -4,23 +4,43 @@ Installability checker for Apt repositories, using dose-debcheck as a backend.
 
 By default, this downloads Packages files for the relevant distributions into a temporary folder
 (as Packages_REPO_DIST_SUITE_ARCH) and outputs results as Installcheck_REPO_DIST_SUITE_ARCH.txt
-in the current folder.
+in the current folder. With --cache-dir, Packages files are kept between runs and only downloaded
+again when their hash in the distribution's Release file changes, and dose-debcheck is only run
+again for targets whose Packages files changed, and then only for the packages in them that changed
+or depend on something that changed.
+
+Besides the text reports, a JSON summary is written for every target as Installcheck_REPO_DIST_SUITE_ARCH.json,
+and with --cache-dir (or --results-db), individual failures are recorded in an SQLite database that is
+kept between runs (installcheck.sqlite in the cache folder by default).
+
+Unless --full-background is given, each target is checked against only the background packages that
+its own packages could transitively depend on, rather than whole background archives.
 """
 
 import argparse
 import collections
 import concurrent.futures
-import gzip
+import functools
+import hashlib
+import json
 import lzma
+import mmap
 import os
+import re
 import shutil
+import sqlite3
 import subprocess
 import tempfile
+import threading
 import traceback
+import zlib
+from array import array
 
 import requests
 import yaml
 
+import runmetrics
+
 RepoTarget = collections.namedtuple('RepoTarget', [
     'repo_name',
     'distribution',
@@ -28,35 +48,546 @@ RepoTarget = collections.namedtuple('RepoTarget', [
     'architecture'
 ])
 
+# Incremental decompressors for each supported Packages file extension
 _ARCHIVE_FORMATS = {
-    'xz': lzma.decompress,
-    'gz': gzip.decompress,
+    'xz': lzma.LZMADecompressor,
+    'gz': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),  # gzip header
 }
-def try_download_packages_file(link, filename, extension):
+_DOWNLOAD_CHUNK_SIZE = 65536
+
+DownloadResult = collections.namedtuple('DownloadResult', [
+    'sha256',  # SHA256 of the decompressed file
+    'etag',
+    'last_modified',
+])
+# Returned by try_download_packages_file when the server reports that the file is unchanged
+NOT_MODIFIED = 'not modified'
+# Directory (relative to the cache dir) holding dose-debcheck results keyed by a hash of their inputs
+_RESULTS_CACHE_DIR = 'results-cache'
+# Directory (relative to the cache dir) holding the last results and input files of each target, for incremental checks
+_INCREMENTAL_DIR = 'incremental'
+# Longest --checkonly argument to pass to dose-debcheck, which must stay below Linux's 128 KiB limit per argument
+_MAX_CHECKONLY_LENGTH = 100000
+
+def try_download_packages_file(link, filename, extension, stats=None, headers=None, expected_sha256=None):
+    """
+    Downloads and decompresses a Packages file, streaming it to disk so that memory use stays bounded.
+    The file is written to a temporary name first and only renamed into place on success, and only if
+    its SHA256 matches expected_sha256 (when given).
+
+    Returns a DownloadResult on success, NOT_MODIFIED if the server replied 304 Not Modified to the
+    given conditional request headers, and None on failure.
+    """
     link = f'{link}.{extension}'
     print('Getting packages link', link)
+    tmp_filename = f'{filename}.part'
     try:
-        r = requests.get(link, timeout=10)
-        r.raise_for_status()  # raise if not success
+        with requests.get(link, timeout=10, stream=True, headers=headers) as r:
+            r.raise_for_status()  # raise if not success
+            if r.status_code == 304:
+                return NOT_MODIFIED
+            decompressor = _ARCHIVE_FORMATS[extension]()
+            sha256 = hashlib.sha256()
+            with open(tmp_filename, 'wb') as out_f:
+                def _write(data):
+                    sha256.update(data)
+                    out_f.write(data)
+                for chunk in r.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
+                    if stats:
+                        stats.add(nbytes=len(chunk))
+                    while chunk:
+                        # Handle files made of multiple concatenated streams, which may end on a chunk boundary
+                        if decompressor.eof:
+                            if extension == 'xz':
+                                # Streams can be followed by null bytes of padding
+                                chunk = chunk.lstrip(b'\0')
+                                if not chunk:
+                                    break
+                            decompressor = _ARCHIVE_FORMATS[extension]()
+                        _write(decompressor.decompress(chunk))
+                        chunk = decompressor.unused_data if decompressor.eof else b''
+                if not decompressor.eof:
+                    raise EOFError(f'{link} ended before the end of the compressed stream')
+            if expected_sha256 and sha256.hexdigest() != expected_sha256:
+                print(f'Hash mismatch for {link}: expected {expected_sha256}, got {sha256.hexdigest()}')
+                return None
+            os.replace(tmp_filename, filename)
     except requests.exceptions.RequestException:
-        return False
+        return None
+    except (lzma.LZMAError, zlib.error, EOFError, OSError):
+        traceback.print_exc()
+        return None
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    if stats:
+        stats.add(items=1)
+    return DownloadResult(sha256.hexdigest(), r.headers.get('ETag'), r.headers.get('Last-Modified'))
 
-    #print(link, r, len(r.content))
-    extract_func = _ARCHIVE_FORMATS[extension]
-    try:
-        data = extract_func(r.content)
-        with open(filename, 'wb') as out_f:
+def parse_release_hashes(text: str) -> dict[str, str]:
+    """
+    Parses the SHA256 field of a Release or InRelease file, returning a mapping of paths to hashes.
+    """
+    hashes = {}
+    in_sha256 = False
+    for line in text.splitlines():
+        if line.startswith('-----BEGIN PGP SIGNATURE'):
+            break
+        if not line.startswith(' '):
+            in_sha256 = line.startswith('SHA256:')
+            continue
+        if in_sha256:
+            parts = line.split()
+            if len(parts) == 3:
+                hashes[parts[2]] = parts[0]
+    return hashes
+
+def parse_pdiff_index(text: str) -> dict:
+    """
+    Parses a Packages.diff/Index file, returning a dict with the following keys:
+     - current: SHA256 of the current Packages file
+     - history: list of (sha256, patch name) pairs for older versions, oldest first
+     - patches: mapping of patch names to the SHA256 of the uncompressed patch
+     - downloads: mapping of patch names to the SHA256 of the compressed (.gz) patch
+     - merged: whether each patch goes straight from its old version to the current one
+    """
+    index = {'current': None, 'history': [], 'patches': {}, 'downloads': {}, 'merged': False}
+    field = None
+    for line in text.splitlines():
+        if not line.startswith(' '):
+            field, _, value = line.partition(':')
+            value = value.strip()
+            if field == 'SHA256-Current':
+                index['current'] = value.split()[0]
+            elif field == 'X-Patch-Precedence':
+                index['merged'] = value == 'merged'
+            continue
+        parts = line.split()
+        if len(parts) != 3:
+            continue
+        sha256, _size, name = parts
+        if field == 'SHA256-History':
+            index['history'].append((sha256, name))
+        elif field == 'SHA256-Patches':
+            index['patches'][name] = sha256
+        elif field == 'SHA256-Download':
+            index['downloads'][name.removesuffix('.gz')] = sha256
+    return index
+
+_ED_COMMAND_REGEX = re.compile(rb'^(\d+)(?:,(\d+))?([acd])$')
+
+def apply_ed_patch(patch: bytes, in_f, out_f):
+    """
+    Applies an ed-style diff (as used by pdiffs) to the lines of in_f, writing the result to out_f.
+    The input is streamed, so only the patch itself is held in memory. Returns the SHA256 of the output.
+    """
+    # Parse all commands first. diff --ed emits them from the end of the file to the start,
+    # so that line numbers stay valid when applied in order by ed.
+    commands = []
+    patch_lines = iter(patch.splitlines(keepends=True))
+    for line in patch_lines:
+        match = _ED_COMMAND_REGEX.match(line.rstrip(b'\n'))
+        if not match:
+            raise ValueError(f'Unsupported ed command {line!r}')
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        command = match.group(3)
+        new_lines = []
+        if command in (b'a', b'c'):
+            for text_line in patch_lines:
+                if text_line == b'.\n':
+                    break
+                new_lines.append(text_line)
+            else:
+                raise ValueError('Unterminated ed text block')
+        commands.append((start, end, command, new_lines))
+
+    sha256 = hashlib.sha256()
+    def _write(data):
+        sha256.update(data)
+        out_f.write(data)
+
+    lineno = 0  # Number of input lines consumed
+    def _copy_until(target_lineno):
+        nonlocal lineno
+        while lineno < target_lineno:
+            line = in_f.readline()
+            if not line:
+                raise ValueError(f'Patch refers to line {target_lineno} past the end of the file')
+            _write(line)
+            lineno += 1
+
+    previous_start = None
+    for start, end, command, new_lines in reversed(commands):
+        if previous_start is not None and start < previous_start:
+            raise ValueError('ed commands are not in descending order')
+        previous_start = start
+        if command == b'a':
+            _copy_until(start)
+        else:
+            _copy_until(start - 1)
+            for _ in range(end - start + 1):
+                if not in_f.readline():
+                    raise ValueError(f'Patch refers to line {end} past the end of the file')
+                lineno += 1
+        for line in new_lines:
+            _write(line)
+    while line := in_f.readline():
+        _write(line)
+    return sha256.hexdigest()
+
+# Fields read when indexing Packages files. Relation fields in Packages files are always on one line.
+_INDEX_FIELD_REGEX = re.compile(rb'^(Package|Provides|Essential): *([^\n]*)', re.M)
+_DEPENDS_FIELD_REGEX = re.compile(rb'^(?:Depends|Pre-Depends): *([^\n]*)', re.M)
+_PROVIDES_FIELD_REGEX = re.compile(rb'^Provides: *([^\n]*)', re.M)
+_CONFLICTS_FIELD_REGEX = re.compile(rb'^(?:Conflicts|Breaks): *([^\n]*)', re.M)
+# Package names in a relation field, ignoring versions and :any / :native qualifiers
+_RELATION_NAME_REGEX = re.compile(rb'(?:^|[,|])\s*([a-z0-9][a-z0-9+.-]*)')
+
+class PackagesIndex():
+    """
+    Index of the stanzas in a Packages file by package name and Provides, backed by a memory map of
+    the file so that stanzas can be read back without parsing the whole file again.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._f = open(filename, 'rb')  # pylint: disable=consider-using-with
+        try:
+            self._data = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty file
+            self._data = b''
+        self.starts = array('Q')
+        self.ends = array('Q')
+        self.names = collections.defaultdict(list)  # package or virtual package name -> stanza indexes
+        self.packages = []  # stanza index -> package name
+        self.essential = []
+
+        data = self._data
+        pos = 0
+        while pos < len(data):
+            end = data.find(b'\n\n', pos)
+            if end == -1:
+                end = len(data)
+                while end > pos and data[end-1:end] == b'\n':
+                    end -= 1
+            if end > pos:
+                index = len(self.starts)
+                self.starts.append(pos)
+                self.ends.append(end)
+                self.packages.append(None)
+                for match in _INDEX_FIELD_REGEX.finditer(data, pos, end):
+                    field, value = match.groups()
+                    if field == b'Package':
+                        self.packages[index] = value.strip()
+                        self.names[value.strip()].append(index)
+                    elif field == b'Provides':
+                        for name in _RELATION_NAME_REGEX.findall(value):
+                            self.names[name].append(index)
+                    elif value.strip() == b'yes':
+                        self.essential.append(index)
+            pos = end + 1
+            # Skip over any extra blank lines between stanzas
+            while pos < len(data) and data[pos:pos+1] == b'\n':
+                pos += 1
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _get_relation_names(self, index: int, field_regex: re.Pattern) -> list[bytes]:
+        names = []
+        for match in field_regex.finditer(self._data, self.starts[index], self.ends[index]):
+            names += _RELATION_NAME_REGEX.findall(match.group(1))
+        return names
+
+    def get_depends(self, index: int) -> list[bytes]:
+        """Returns the names of all packages in the Depends and Pre-Depends of a stanza, including alternatives."""
+        return self._get_relation_names(index, _DEPENDS_FIELD_REGEX)
+
+    def get_provides(self, index: int) -> list[bytes]:
+        return self._get_relation_names(index, _PROVIDES_FIELD_REGEX)
+
+    def get_conflicts(self, index: int) -> list[bytes]:
+        """Returns the names of all packages in the Conflicts and Breaks of a stanza."""
+        return self._get_relation_names(index, _CONFLICTS_FIELD_REGEX)
+
+    def get_stanza_hashes(self) -> dict[bytes, set[bytes]]:
+        """Returns a mapping of package names to the hashes of their stanzas."""
+        hashes = collections.defaultdict(set)
+        for index, package in enumerate(self.packages):
+            hashes[package].add(hashlib.sha1(self.get_stanza(index)).digest())
+        return hashes
+
+    def get_stanza(self, index: int) -> bytes:
+        return self._data[self.starts[index]:self.ends[index]]
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._f.close()
+
+def get_dependency_closure(fg_index: PackagesIndex, bg_indexes: list[PackagesIndex]) -> list[list[int]]:
+    """
+    Returns, for each background index, the sorted stanza indexes of all background packages that any
+    foreground package could transitively depend on (or that are Essential, which dose-debcheck always
+    installs). Version constraints are ignored, so this is a superset of what could actually be installed.
+    """
+    selected = [set() for _ in bg_indexes]
+    queue = []
+    for index in range(len(fg_index)):
+        queue += fg_index.get_depends(index)
+    for bg_index, bg_selected in zip(bg_indexes, selected):
+        for index in bg_index.essential:
+            bg_selected.add(index)
+            queue += bg_index.get_depends(index)
+
+    seen_names = set()
+    while queue:
+        name = queue.pop()
+        if name in seen_names:
+            continue
+        seen_names.add(name)
+        for bg_index, bg_selected in zip(bg_indexes, selected):
+            for index in bg_index.names.get(name, ()):
+                if index not in bg_selected:
+                    bg_selected.add(index)
+                    queue += bg_index.get_depends(index)
+    return [sorted(bg_selected) for bg_selected in selected]
+
+def get_changed_names(old_index: PackagesIndex, new_index: PackagesIndex) -> set[bytes]:
+    """
+    Returns the names of packages that were added, removed or changed between two versions of a Packages
+    file, along with any names that they provide or conflict with. Returns None if an Essential package
+    changed, as that can affect every package.
+    """
+    old_hashes = old_index.get_stanza_hashes()
+    new_hashes = new_index.get_stanza_hashes()
+    changed_packages = {package for package in old_hashes.keys() | new_hashes.keys()
+                        if old_hashes.get(package) != new_hashes.get(package)}
+
+    changed_names = set(changed_packages)
+    for index_obj in (old_index, new_index):
+        essential = set(index_obj.essential)
+        for package in changed_packages:
+            for index in index_obj.names.get(package, ()):
+                if index_obj.packages[index] != package:
+                    continue  # Only a provider of this name
+                if index in essential:
+                    return None
+                changed_names.update(index_obj.get_provides(index))
+                changed_names.update(index_obj.get_conflicts(index))
+    return changed_names
+
+def get_reverse_closure(names: set[bytes], indexes: list[PackagesIndex]) -> set[bytes]:
+    """
+    Returns the names of all packages (in any of the given indexes) that could transitively depend on
+    any of the given names, including the names themselves.
+    """
+    reverse_depends = collections.defaultdict(list)  # name -> (index object, stanza index) depending on it
+    for index_obj in indexes:
+        for index in range(len(index_obj)):
+            for name in index_obj.get_depends(index):
+                reverse_depends[name].append((index_obj, index))
+
+    seen_names = set()
+    queue = list(names)
+    while queue:
+        name = queue.pop()
+        if name in seen_names:
+            continue
+        seen_names.add(name)
+        for index_obj, index in reverse_depends.get(name, ()):
+            queue.append(index_obj.packages[index])
+            queue += index_obj.get_provides(index)
+    return seen_names
+
+def iter_dose_report(lines):
+    """
+    Streams dose-debcheck YAML output, yielding (package name, entry lines) for each entry of its report
+    section and (None, line) for every other line, so that only one entry is held in memory at a time.
+    """
+    entry = None
+    in_report = False
+    for line in lines:
+        if in_report and line.startswith(' '):
+            if line.rstrip() == ' -':
+                if entry:
+                    yield entry[0], entry[1]
+                entry = ['', [line]]
+            elif entry:
+                entry[1].append(line)
+                if not entry[0] and line.startswith('  package:'):
+                    entry[0] = line.split(':', 1)[1].strip()
+            continue
+        if entry:
+            yield entry[0], entry[1]
+            entry = None
+        in_report = line.startswith('report:')
+        yield None, line
+    if entry:
+        yield entry[0], entry[1]
+
+def parse_dose_entry(entry_lines: list[str]):
+    """
+    Parses one entry of a dose-debcheck report, returning its top-level fields and a list of reasons. Each
+    reason is a dict with a 'type' ('missing' or 'conflict') and the fields of its pkg / pkg1 / pkg2 blocks.
+    """
+    fields = {}
+    reasons = []
+    block = None
+    block_indent = 0
+    for line in entry_lines:
+        stripped = line.strip()
+        indent = len(line) - len(line.lstrip(' '))
+        if stripped == '-':
+            if indent == 3:
+                reasons.append({})
+                block = None
+            continue
+        key, _, value = stripped.partition(':')
+        value = value.strip()
+        if indent == 2:
+            if key != 'reasons':
+                fields[key] = value
+        elif not reasons:
+            continue
+        elif key in ('missing', 'conflict') and not value:
+            reasons[-1]['type'] = key
+            block = None
+        elif key in ('pkg', 'pkg1', 'pkg2') and not value:
+            block = reasons[-1].setdefault(key, {})
+            block_indent = indent
+        elif key == 'depchains':
+            block = None
+        elif block is not None and indent == block_indent + 1:
+            block[key] = value
+    return fields, reasons
+
+def iter_dose_failures(lines):
+    """
+    Streams dose-debcheck output, yielding a dict for each reason that each broken package is broken.
+    """
+    for package, entry_lines in iter_dose_report(lines):
+        if package is None:
+            continue
+        fields, reasons = parse_dose_entry(entry_lines)
+        for reason in reasons or [{}]:
+            culprit = reason.get('pkg') or reason.get('pkg1') or {}
+            other = reason.get('pkg2')
+            yield {
+                'package': fields.get('package', package),
+                'version': fields.get('version'),
+                'architecture': fields.get('architecture'),
+                'reason': reason.get('type'),
+                # The package whose dependency or conflict can't be satisfied
+                'culprit': culprit.get('package'),
+                'relation': culprit.get('unsat-dependency') or culprit.get('unsat-conflict'),
+                'conflict_package': f"{other.get('package')} ({other.get('version')})" if other else None,
+            }
+
+def merge_dose_reports(old_filename: str, new_filename: str, out_filename: str, checked: set[str], packages: set[str]) -> int:
+    """
+    Merges the output of a dose-debcheck run limited to the checked packages (new_filename) into the output
+    of an earlier full run (old_filename), writing the result to out_filename. Entries for packages that are
+    no longer in the foreground (i.e. not in packages) are dropped. If new_filename is None, only the
+    old report is filtered. Returns the number of broken packages.
+    """
+    new_entries = []
+    if new_filename:
+        with open(new_filename, encoding='utf8') as f:
+            new_entries = [entry_lines for package, entry_lines in iter_dose_report(f) if package is not None]
+
+    count = 0
+    report_started = False
+    report_finished = False
+    with open(old_filename, encoding='utf8') as old_f, open(out_filename, 'w', encoding='utf8') as out_f:
+        def _write_entry(entry_lines):
+            nonlocal count, report_started
+            if not report_started:
+                out_f.write('report:\n')
+                report_started = True
+            out_f.writelines(entry_lines)
+            count += 1
+
+        def _finish_report():
+            nonlocal report_finished
+            if not report_finished:
+                for entry_lines in new_entries:
+                    _write_entry(entry_lines)
+                report_finished = True
+
+        in_report = False
+        for package, data in iter_dose_report(old_f):
+            if package is not None:
+                if package not in checked and package in packages:
+                    _write_entry(data)
+                continue
+            if data.startswith('report:'):
+                in_report = True
+                continue
+            if in_report or data.startswith('background-packages:'):
+                # New entries go at the end of the report, or before the statistics if there were no failures
+                _finish_report()
+                in_report = False
+            if data.startswith('broken-packages:'):
+                data = f'broken-packages: {count}\n'
+            elif data.startswith(('missing-packages:', 'conflict-packages:')):
+                # These can't be recomputed without parsing the explanations
+                continue
             out_f.write(data)
-    except ValueError:
-        traceback.print_exc()
-        return False
-    return True
+        _finish_report()
+    return count
+
+class ResultsStore():
+    """
+    SQLite store of per-package installability failures, which are replaced for each target checked.
+    """
+    def __init__(self, filename: str):
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS targets (
+                repo TEXT, distribution TEXT, suite TEXT, architecture TEXT, returncode INTEGER, broken_packages INTEGER,
+                PRIMARY KEY (repo, distribution, suite, architecture))''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS failures (
+                repo TEXT, distribution TEXT, suite TEXT, architecture TEXT,
+                package TEXT, version TEXT, package_architecture TEXT,
+                reason TEXT, culprit TEXT, relation TEXT, conflict_package TEXT)''')
+            self._db.execute('''CREATE INDEX IF NOT EXISTS failures_target
+                ON failures (repo, distribution, suite, architecture)''')
+
+    def record(self, target: RepoTarget, returncode: int, failures) -> set[str]:
+        """Replaces the results for a target with the given failures (streamed), returning the names of broken packages."""
+        broken = set()
+        def _rows():
+            for failure in failures:
+                broken.add(failure['package'])
+                yield (*target, failure['package'], failure['version'], failure['architecture'],
+                       failure['reason'], failure['culprit'], failure['relation'], failure['conflict_package'])
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM failures WHERE repo = ? AND distribution = ? AND suite = ? AND architecture = ?', target)
+            self._db.executemany('INSERT INTO failures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', _rows())
+            self._db.execute('INSERT OR REPLACE INTO targets VALUES (?, ?, ?, ?, ?, ?)', (*target, returncode, len(broken)))
+        return broken
+
+    def close(self):
+        self._db.close()
 
 class InstallCheck():
 
-    def __init__(self, config_path: str):
+    def __init__(self, config_path: str, metrics: runmetrics.RunMetrics = None):
         with open(config_path, encoding='utf8') as f:
             self.config = yaml.safe_load(f)
+        self.metrics = metrics or runmetrics.RunMetrics('installcheck')
+        self._release_hashes = {}
+        self._release_locks = {}
+        self._release_lock = threading.Lock()
+        self._used_result_keys = set()
+        self._results_lock = threading.Lock()
+        self._indexes = {}
+        self._index_locks = {}
+        self._indexes_lock = threading.Lock()
+        self.results_store = None
 
     @staticmethod
     def get_packages_filename(target: RepoTarget) -> str:
@@ -64,10 +595,39 @@ class InstallCheck():
         # pylint: disable=consider-using-f-string
         return 'Packages_%s_%s_%s_%s' % target
 
-    def download_packages_file(self, target: RepoTarget, skip_download=False):
+    def get_release_hashes(self, repo_name: str, distribution: str) -> dict[str, str]:
+        """
+        Returns a mapping of paths in a distribution's InRelease (or Release) file to their SHA256
+        hashes, or an empty dict if neither could be fetched. Results are cached for the whole run.
+        """
+        url = self.config["repos"][repo_name]
+        key = (repo_name, distribution)
+        with self._release_lock:
+            dist_lock = self._release_locks.setdefault(key, threading.Lock())
+        with dist_lock:
+            if key not in self._release_hashes:
+                hashes = {}
+                for release_name in ('InRelease', 'Release'):
+                    link = f'{url}/dists/{distribution}/{release_name}'
+                    try:
+                        r = requests.get(link, timeout=10)
+                        r.raise_for_status()
+                    except requests.exceptions.RequestException:
+                        continue
+                    print('Got release file', link)
+                    hashes = parse_release_hashes(r.text)
+                    break
+                self._release_hashes[key] = hashes
+            return self._release_hashes[key]
+
+    def download_packages_file(self, target: RepoTarget, skip_download=False, use_cache=False):
         """
         Gets the Packages file given the repository, distribution, suite, and
         architecture.
+
+        If use_cache is set, an existing Packages file is only downloaded again if its SHA256 no longer
+        matches the one in the distribution's Release file, or (if that is unavailable) if the server
+        doesn't report it as unmodified. Changed files are updated using pdiffs where possible.
         """
         url = self.config["repos"][target.repo_name]
         # Example: http://deb.debian.org/debian/dists/sid/main/binary-amd64/
@@ -75,17 +635,368 @@ class InstallCheck():
         filename = self.get_packages_filename(target)
 
         if not skip_download:
-            for ext in _ARCHIVE_FORMATS:
-                if try_download_packages_file(link, filename, ext):
-                    break
-            else:
-                print(f'Failed to download any package file for {filename}')
+            expected_sha256 = None
+            headers = {}
+            meta = {}
+            if use_cache:
+                release_hashes = self.get_release_hashes(target.repo_name, target.distribution)
+                expected_sha256 = release_hashes.get(f'{target.suite}/binary-{target.architecture}/Packages')
+                meta = self._read_cache_meta(filename)
+                if meta and os.path.isfile(filename):
+                    if expected_sha256 and meta.get('sha256') == expected_sha256:
+                        print(f'Packages file {filename} is up to date')
+                        return
+                    if not expected_sha256:
+                        # No Release file to compare against, so fall back to a conditional request
+                        if meta.get('etag'):
+                            headers['If-None-Match'] = meta['etag']
+                        if meta.get('last_modified'):
+                            headers['If-Modified-Since'] = meta['last_modified']
+
+            with self.metrics.phase('download', filename) as stats:
+                if use_cache and expected_sha256 and meta.get('sha256') and os.path.isfile(filename):
+                    if self.try_pdiff_update(link, filename, meta['sha256'], expected_sha256, stats=stats):
+                        self._write_cache_meta(filename, {'sha256': expected_sha256})
+                        return
+
+                for ext in _ARCHIVE_FORMATS:
+                    # Validators are specific to the compressed file they were sent for
+                    ext_headers = headers if meta.get('extension') == ext else {}
+                    result = try_download_packages_file(link, filename, ext, stats=stats,
+                                                        headers=ext_headers, expected_sha256=expected_sha256)
+                    if result == NOT_MODIFIED:
+                        print(f'Packages file {filename} is not modified')
+                        break
+                    if result:
+                        if use_cache:
+                            self._write_cache_meta(filename, {
+                                'sha256': result.sha256,
+                                'etag': result.etag,
+                                'last_modified': result.last_modified,
+                                'extension': ext,
+                            })
+                        break
+                else:
+                    print(f'Failed to download any package file for {filename}')
+                    if use_cache and os.path.exists(filename):
+                        # Never check against an outdated copy
+                        print(f'Removing outdated Packages file {filename}')
+                        os.remove(filename)
         else:
             if os.path.isfile(filename):
                 print('Reusing Packages file %s' % filename)
             else:
                 print('Missing Packages file %s; some tests may be skipped!' % filename)
 
+    def try_pdiff_update(self, link: str, filename: str, current_sha256: str, expected_sha256: str, stats=None) -> bool:
+        """
+        Tries to update a cached Packages file from current_sha256 to expected_sha256 using the pdiffs
+        in Packages.diff/. Returns True if the file was updated and matches expected_sha256.
+        """
+        try:
+            r = requests.get(f'{link}.diff/Index', timeout=10)
+            r.raise_for_status()
+        except requests.exceptions.RequestException:
+            return False
+        index = parse_pdiff_index(r.text)
+        if index['current'] != expected_sha256:
+            print(f'pdiff index for {link} is not in sync with the Release file')
+            return False
+
+        history_names = [name for sha256, name in index['history'] if sha256 == current_sha256]
+        if not history_names:
+            print(f'No pdiff path from the cached {filename}')
+            return False
+        if index['merged']:
+            # Merged patches go straight from the old version to the current one
+            patch_names = history_names[-1:]
+        else:
+            all_names = [name for _sha256, name in index['history']]
+            patch_names = all_names[all_names.index(history_names[-1]):]
+
+        tmp_filenames = [f'{filename}.pdiff-a', f'{filename}.pdiff-b']
+        source = filename
+        try:
+            for i, patch_name in enumerate(patch_names):
+                patch_link = f'{link}.diff/{patch_name}.gz'
+                print('Getting pdiff', patch_link)
+                r = requests.get(patch_link, timeout=10)
+                r.raise_for_status()
+                if stats:
+                    stats.add(nbytes=len(r.content))
+                if hashlib.sha256(r.content).hexdigest() != index['downloads'].get(patch_name):
+                    raise ValueError(f'Hash mismatch for {patch_link}')
+                patch = zlib.decompress(r.content, 16 + zlib.MAX_WBITS)
+                if hashlib.sha256(patch).hexdigest() != index['patches'].get(patch_name):
+                    raise ValueError(f'Hash mismatch for uncompressed {patch_link}')
+
+                dest = tmp_filenames[i % 2]
+                with open(source, 'rb') as in_f, open(dest, 'wb') as out_f:
+                    result_sha256 = apply_ed_patch(patch, in_f, out_f)
+                source = dest
+
+            if result_sha256 != expected_sha256:
+                raise ValueError(f'Hash mismatch after applying pdiffs to {filename}')
+            os.replace(source, filename)
+        except (requests.exceptions.RequestException, ValueError, zlib.error, OSError) as e:
+            print(f'Failed to apply pdiffs to {filename}: {e}')
+            return False
+        finally:
+            for tmp_filename in tmp_filenames:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+        print(f'Updated {filename} using {len(patch_names)} pdiff(s)')
+        if stats:
+            stats.add(items=1)
+        return True
+
+    @staticmethod
+    def _read_cache_meta(filename: str) -> dict:
+        """
+        Reads the cache metadata stored alongside a Packages file, returning an empty dict if missing or
+        if it was written for a different version of the file.
+        """
+        try:
+            with open(f'{filename}.meta', encoding='utf8') as f:
+                meta = json.load(f)
+            st = os.stat(filename)
+        except (ValueError, OSError):
+            return {}
+        # The Packages file may have been replaced without its metadata being updated (e.g. if we were
+        # interrupted in between), in which case none of it can be trusted
+        if meta.get('stat') != [st.st_ino, st.st_size, st.st_mtime_ns]:
+            return {}
+        return meta
+
+    @staticmethod
+    def _write_cache_meta(filename: str, meta: dict):
+        st = os.stat(filename)
+        # Files are always replaced by renaming a new file over them, which changes the inode number
+        meta = dict(meta, stat=[st.st_ino, st.st_size, st.st_mtime_ns])
+        with open(f'{filename}.meta.tmp', 'w', encoding='utf8') as f:
+            json.dump(meta, f)
+        os.replace(f'{filename}.meta.tmp', f'{filename}.meta')
+
+    def get_file_sha256(self, filename: str) -> str:
+        """
+        Returns the SHA256 of a Packages file, using the hash recorded in its cache metadata if available.
+        """
+        sha256 = self._read_cache_meta(filename).get('sha256')
+        if sha256:
+            return sha256
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            while chunk := f.read(_DOWNLOAD_CHUNK_SIZE):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def get_result_key(self, cmd: list[str], filenames: list[str], **options) -> str:
+        """
+        Returns a hash identifying a dose-debcheck run by its command line, the contents of its input files
+        and any other options that affect how it is run.
+        """
+        inputs = {
+            'cmd': cmd,
+            'files': {filename: self.get_file_sha256(filename) for filename in filenames},
+            'options': options,
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def get_cached_result(self, key: str, report_filename: str):
+        """
+        Copies the cached output of a dose-debcheck run to report_filename, returning its return code,
+        or None if it is not cached.
+        """
+        with self._results_lock:
+            self._used_result_keys.add(key)
+        filename = os.path.join(_RESULTS_CACHE_DIR, key)
+        try:
+            with open(f'{filename}.json', encoding='utf8') as f:
+                returncode = json.load(f)['returncode']
+            shutil.copyfile(f'{filename}.txt', report_filename)
+            return returncode
+        except (ValueError, KeyError, OSError):
+            return None
+
+    @staticmethod
+    def put_cached_result(key: str, returncode: int, report_filename: str):
+        os.makedirs(_RESULTS_CACHE_DIR, exist_ok=True)
+        filename = os.path.join(_RESULTS_CACHE_DIR, key)
+        shutil.copyfile(report_filename, f'{filename}.txt')
+        # Written last, so that a result is only used if its output was saved in full
+        with open(f'{filename}.json.tmp', 'w', encoding='utf8') as f:
+            json.dump({'returncode': returncode}, f)
+        os.replace(f'{filename}.json.tmp', f'{filename}.json')
+
+    def prune_cached_results(self):
+        """Removes cached dose-debcheck results that were not used in this run."""
+        if not os.path.isdir(_RESULTS_CACHE_DIR):
+            return
+        for filename in os.listdir(_RESULTS_CACHE_DIR):
+            if filename.split('.', 1)[0] not in self._used_result_keys:
+                print(f'Removing stale cached result {filename}')
+                os.remove(os.path.join(_RESULTS_CACHE_DIR, filename))
+
+    def get_packages_index(self, filename: str) -> PackagesIndex:
+        """Returns a PackagesIndex for a Packages file, which is built once and shared by all targets in a run."""
+        with self._indexes_lock:
+            file_lock = self._index_locks.setdefault(filename, threading.Lock())
+        with file_lock:
+            if filename not in self._indexes:
+                with self.metrics.phase('index', filename) as stats:
+                    self._indexes[filename] = index = PackagesIndex(filename)
+                    stats.add(items=len(index), nbytes=len(index._data))
+            return self._indexes[filename]
+
+    def close_packages_indexes(self):
+        with self._indexes_lock:
+            for index in self._indexes.values():
+                index.close()
+            self._indexes.clear()
+
+    def write_pruned_background(self, target_filename: str, bg_filenames: list[str], outfilename: str):
+        """
+        Writes the packages from bg_filenames that the packages in target_filename could depend on
+        into outfilename, so that dose-debcheck doesn't have to load whole background archives.
+        """
+        with self.metrics.phase('prune', target_filename) as stats:
+            fg_index = self.get_packages_index(target_filename)
+            bg_indexes = [self.get_packages_index(filename) for filename in bg_filenames]
+            closure = get_dependency_closure(fg_index, bg_indexes)
+            with open(outfilename, 'wb') as f:
+                for bg_index, indexes in zip(bg_indexes, closure):
+                    for index in indexes:
+                        f.write(bg_index.get_stanza(index))
+                        f.write(b'\n\n')
+            kept = sum(len(indexes) for indexes in closure)
+            total = sum(len(bg_index) for bg_index in bg_indexes)
+            stats.add(items=kept, nbytes=os.path.getsize(outfilename))
+        print(f'Pruned background for {target_filename} to {kept} of {total} packages')
+
+    @staticmethod
+    def _get_incremental_state_filename(target_filename: str) -> str:
+        return os.path.join(_INCREMENTAL_DIR, f'{target_filename}.json')
+
+    @staticmethod
+    def _get_incremental_report_filename(target_filename: str) -> str:
+        return os.path.join(_INCREMENTAL_DIR, f'{target_filename}.txt')
+
+    def save_incremental_state(self, target_filename: str, input_filenames: list[str], returncode: int, report_filename: str):
+        """
+        Saves the result of checking a target along with copies of its input files (hardlinked by hash), so that
+        the next run can work out which packages changed. Hardlinked copies change along with input files that
+        are written in place, so get_packages_to_check() verifies them before use.
+        """
+        files_dir = os.path.join(_INCREMENTAL_DIR, 'files')
+        os.makedirs(files_dir, exist_ok=True)
+        files = []
+        for filename in input_filenames:
+            sha256 = self.get_file_sha256(filename)
+            copy_filename = os.path.join(files_dir, sha256)
+            with self._results_lock:
+                if not os.path.exists(copy_filename):
+                    try:
+                        os.link(filename, copy_filename)
+                    except OSError:
+                        # e.g. the cache is on another filesystem, or it doesn't support hardlinks
+                        shutil.copyfile(filename, f'{copy_filename}.tmp')
+                        os.replace(f'{copy_filename}.tmp', copy_filename)
+            files.append([filename, sha256])
+
+        shutil.copyfile(report_filename, self._get_incremental_report_filename(target_filename))
+        state_filename = self._get_incremental_state_filename(target_filename)
+        with open(f'{state_filename}.tmp', 'w', encoding='utf8') as f:
+            json.dump({'files': files, 'returncode': returncode}, f)
+        os.replace(f'{state_filename}.tmp', state_filename)
+
+    def get_packages_to_check(self, target_filename: str, input_filenames: list[str]):
+        """
+        Compares a target's input files to those of the last run, returning (last run's state, set of
+        package names to check), or None if the whole target must be checked again.
+        """
+        try:
+            with open(self._get_incremental_state_filename(target_filename), encoding='utf8') as f:
+                state = json.load(f)
+        except (ValueError, OSError):
+            return None
+        if [filename for filename, _sha256 in state['files']] != input_filenames:
+            return None
+        if not os.path.isfile(self._get_incremental_report_filename(target_filename)):
+            return None
+
+        with self.metrics.phase('diff', target_filename):
+            changed_names = set()
+            for filename, old_sha256 in state['files']:
+                if self.get_file_sha256(filename) == old_sha256:
+                    continue
+                old_filename = os.path.join(_INCREMENTAL_DIR, 'files', old_sha256)
+                if not os.path.isfile(old_filename):
+                    return None
+                if self.get_file_sha256(old_filename) != old_sha256:
+                    # The copy is a hardlink to an input file that was since changed in place
+                    print(f'Checking all of {target_filename}, as the saved copy of {filename} was modified')
+                    os.remove(old_filename)
+                    return None
+                names = get_changed_names(self.get_packages_index(old_filename), self.get_packages_index(filename))
+                if names is None:
+                    print(f'Checking all of {target_filename}, as Essential packages in {filename} changed')
+                    return None
+                changed_names |= names
+
+            fg_index = self.get_packages_index(target_filename)
+            to_check = set()
+            if changed_names:
+                indexes = [self.get_packages_index(filename) for filename in input_filenames]
+                affected_names = get_reverse_closure(changed_names, indexes)
+                to_check = {package.decode() for package in fg_index.packages if package in affected_names}
+            if len(to_check) > len(fg_index) // 2:
+                # Not worth merging results
+                return None
+            if sum(len(package) + 1 for package in to_check) > _MAX_CHECKONLY_LENGTH:
+                print(f'Checking all of {target_filename}, as too many packages changed to list them for dose-debcheck')
+                return None
+        return state, to_check
+
+    def merge_incremental_report(self, target_filename: str, new_report_filename: str, report_filename: str,
+                                 checked: set[str]) -> int:
+        """
+        Merges a report for the checked packages (if any) into the last run's report for a target, writing the
+        result to report_filename. Returns the return code that a full dose-debcheck run would have had.
+        """
+        packages = {package.decode() for package in self.get_packages_index(target_filename).packages if package}
+        merged_filename = f'{report_filename}.merged'
+        broken_count = merge_dose_reports(self._get_incremental_report_filename(target_filename),
+                                          new_report_filename, merged_filename, checked, packages)
+        os.replace(merged_filename, report_filename)
+        return 1 if broken_count else 0
+
+    def prune_incremental_state(self, target_filenames: set[str]):
+        """Removes incremental check state for targets that are no longer checked, and input file copies that are unused."""
+        if not os.path.isdir(_INCREMENTAL_DIR):
+            return
+        used_hashes = set()
+        for filename in os.listdir(_INCREMENTAL_DIR):
+            state_filename = os.path.join(_INCREMENTAL_DIR, filename)
+            if not filename.endswith('.json'):
+                continue
+            if filename.removesuffix('.json') not in target_filenames:
+                print(f'Removing stale incremental check state {filename}')
+                os.remove(state_filename)
+                report_filename = self._get_incremental_report_filename(filename.removesuffix('.json'))
+                if os.path.exists(report_filename):
+                    os.remove(report_filename)
+                continue
+            try:
+                with open(state_filename, encoding='utf8') as f:
+                    used_hashes.update(sha256 for _filename, sha256 in json.load(f)['files'])
+            except (ValueError, KeyError, OSError):
+                continue
+        files_dir = os.path.join(_INCREMENTAL_DIR, 'files')
+        if os.path.isdir(files_dir):
+            for sha256 in os.listdir(files_dir):
+                if sha256 not in used_hashes:
+                    os.remove(os.path.join(files_dir, sha256))
+
     def get_deps(self, target: RepoTarget) -> set[RepoTarget]:
         """Get dependencies for a RepoTarget"""
         deps = self.config["suite_dependencies"][f"{target.repo_name}/{target.suite}"]
@@ -103,9 +1014,72 @@ class InstallCheck():
             ))
         return results
 
-    def test_dist(self, target: RepoTarget, outfilename: str):
+    def run_dose_debcheck(self, cmd: list[str], target_filename: str, report_filename: str) -> int:
+        """Runs dose-debcheck, writing its output to report_filename and returning its return code."""
+        print('Running command', cmd)
+        with self.metrics.phase('check', target_filename) as stats, \
+                open(report_filename, 'w', encoding='utf8') as report_f:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+            # Read stdout as dose-debcheck runs instead of only returning results at the end.
+            for line in process.stdout:
+                line = line.decode()
+                print(line, end='')
+                report_f.write(line)
+                stats.add(items=1, nbytes=len(line))
+
+            returncode = process.wait()
+        print('process returncode: %s' % returncode)
+        return returncode
+
+    def record_results(self, target: RepoTarget, returncode: int, report_filename: str, outfilename: str):
+        """
+        Writes the text report (for failing targets) and a JSON summary for a target, and adds its failures
+        to the results store if one is open.
+        """
+        if returncode:
+            with open(outfilename, 'w', encoding='utf8') as outfile, open(report_filename, encoding='utf8') as report_f:
+                # Only write reports for combinations that fail testing.
+                if os.path.getsize(report_filename):
+                    outfile.write(f'Results for {target}:\n')
+                shutil.copyfileobj(report_f, outfile)
+
+        counts = collections.Counter()
+        def _count(failures):
+            for failure in failures:
+                counts[failure['reason']] += 1
+                yield failure
+
+        with open(report_filename, encoding='utf8') as report_f:
+            failures = _count(iter_dose_failures(report_f))
+            if self.results_store:
+                broken = self.results_store.record(target, returncode, failures)
+            else:
+                broken = {failure['package'] for failure in failures}
+
+        summary = {
+            **target._asdict(),
+            'returncode': returncode,
+            'broken_packages': sorted(broken),
+            'missing': counts['missing'],
+            'conflict': counts['conflict'],
+        }
+        summary_filename = os.path.splitext(outfilename)[0] + '.json'
+        with open(summary_filename, 'w', encoding='utf8') as f:
+            json.dump(summary, f)
+
+    def test_dist(self, target: RepoTarget, outfilename: str, use_cache=False, prune_background=False, incremental=False):
         """
         Runs dose-debcheck on a repo, dist, suite, and arch pair.
+
+        If use_cache is set, results are cached under a hash of the command line and the input Packages
+        files, and reused in later runs if none of these changed.
+
+        If prune_background is set, the background Packages files are replaced with a single file holding
+        only the packages that the target's packages could depend on.
+
+        If incremental (and use_cache) is set, only packages that changed since the last run, or that depend
+        on packages that changed, are checked, and the results are merged into those of the last run.
         """
         target_filename = self.get_packages_filename(target)
         if not os.path.exists(target_filename):
@@ -117,36 +1091,85 @@ class InstallCheck():
         #  dose-debcheck -fe Packages_of_target --bg Packages_of_dependency_1
         #  --bg Packages_of_dependency_2 ...
         cmd = ['dose-debcheck', '-fe', target_filename]
-        for dep_target in deps:
+        input_filenames = [target_filename]
+        # Sort so that the command line (and thus the result cache key) is stable between runs
+        for dep_target in sorted(deps):
             dep_target_filename = self.get_packages_filename(dep_target)
             if not os.path.exists(dep_target_filename):
                 print(f"Skipping dist {target} due to unavailable dependency {dep_target}")
                 return
 
             cmd += ['--bg', dep_target_filename]
+            input_filenames.append(dep_target_filename)
 
-        print('Running command', cmd)
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-
-        # Read stdout as dose-debcheck runs instead of only returning results at the end.
-        lines = []  # XXX: is storing the output text this way this efficient?
-        for line in process.stdout:
-            line = line.decode()
-            print(line, end='')
-            lines.append(line)
-
-        process.wait()
-        print('process returncode: %s' % process.returncode)
-        if process.returncode:
-            with open(outfilename, 'w', encoding='utf8') as outfile:
-                # Only write reports for combinations that fail testing.
-                if lines:
-                    outfile.write(f'Results for {target}:\n')
-                outfile.writelines(lines)
+        # pylint: disable=consider-using-f-string
+        report_filename = 'Report_%s_%s_%s_%s' % target
+        try:
+            returncode = None
+            result_key = None
+            if use_cache:
+                result_key = self.get_result_key(cmd, input_filenames, prune_background=prune_background)
+                returncode = self.get_cached_result(result_key, report_filename)
+            cached = returncode is not None
+            incremental_check = None
+            if cached:
+                print(f'Reusing cached result for {target}, as its inputs have not changed')
+                self.metrics.get('check_cached', target_filename).add(items=1)
+            elif use_cache and incremental:
+                incremental_check = self.get_packages_to_check(target_filename, input_filenames)
+
+            if incremental_check and not incremental_check[1]:
+                print(f'Reusing previous result for {target}, as no packages it depends on changed')
+                # Still drop entries for packages that were removed from the target
+                returncode = self.merge_incremental_report(target_filename, None, report_filename, set())
+                self.metrics.get('check_cached', target_filename).add(items=1)
+            elif not cached:
+                pruned_filename = None
+                if prune_background and len(input_filenames) > 1:
+                    # pylint: disable=consider-using-f-string
+                    pruned_filename = 'Background_%s_%s_%s_%s' % target
+                    self.write_pruned_background(target_filename, input_filenames[1:], pruned_filename)
+                    cmd = ['dose-debcheck', '-fe', target_filename, '--bg', pruned_filename]
+                if incremental_check:
+                    print(f'Only checking {len(incremental_check[1])} changed or affected packages in {target}')
+                    cmd.append('--checkonly=' + ','.join(sorted(incremental_check[1])))
+
+                try:
+                    returncode = self.run_dose_debcheck(cmd, target_filename, report_filename)
+                finally:
+                    if pruned_filename:
+                        os.remove(pruned_filename)
+                if incremental_check and returncode in (0, 1):
+                    returncode = self.merge_incremental_report(target_filename, report_filename, report_filename,
+                                                               incremental_check[1])
+                if result_key and returncode in (0, 1):
+                    # Other return codes mean that dose-debcheck itself failed, so don't cache those
+                    self.put_cached_result(result_key, returncode, report_filename)
+
+            with self.metrics.phase('record', target_filename):
+                self.record_results(target, returncode, report_filename, outfilename)
+            if use_cache and returncode in (0, 1):
+                try:
+                    self.save_incremental_state(target_filename, input_filenames, returncode, report_filename)
+                except OSError as e:
+                    # The next run will just check the whole target again
+                    print(f'Failed to save incremental state for {target_filename}: {e}')
+        finally:
+            if os.path.exists(report_filename):
+                os.remove(report_filename)
 
-    def run(self, outdir: str, skip_download=False, max_workers=1, tmpdir=None):
+    def run(self, outdir: str, skip_download=False, max_workers=1, tmpdir=None, use_cache=False, max_download_workers=4,
+            prune_background=True, incremental=True, results_db=None):
+        """
+        Downloads Packages files and runs dose-debcheck on every target. Downloads and checks use separate
+        thread pools (of max_download_workers and max_workers threads), and each target is checked as soon
+        as its own Packages file and those of its dependencies are ready.
+
+        Failures are recorded in an SQLite database at results_db, which defaults to installcheck.sqlite in
+        tmpdir if use_cache is set. Otherwise, failures are only recorded if results_db is given.
+        """
         to_download = set()
-        targets = set()
+        targets = {}  # target -> Packages files it needs
         for target_dist_info in self.config["target_dists"]:
             for suite in target_dist_info["suites"]:
                 for arch in self.config["target_archs"]:
@@ -156,47 +1179,111 @@ class InstallCheck():
                         suite,
                         arch
                     )
-                    targets.add(target)
-                    to_download.add(target)
-                    to_download |= self.get_deps(target)
+                    targets[target] = {target} | self.get_deps(target)
+                    to_download |= targets[target]
 
+        outdir = os.path.abspath(outdir)
+        os.makedirs(outdir, exist_ok=True)
+        if not results_db and use_cache and tmpdir:
+            # Keep the database with the rest of the cache, rather than in a (possibly new) output folder each run
+            results_db = os.path.join(tmpdir, 'installcheck.sqlite')
+        if results_db:
+            os.makedirs(os.path.dirname(os.path.abspath(results_db)), exist_ok=True)
+            self.results_store = ResultsStore(results_db)
         if tmpdir:
             os.chdir(tmpdir)
 
-        print('targets:', targets)
+        print('targets:', set(targets))
         print('to_download:', to_download)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            download_futures = {
-                executor.submit(self.download_packages_file, target, skip_download=skip_download)
-                for target in to_download
-            }
+
+        lock = threading.Lock()
+        remaining = {target: set(needed) for target, needed in targets.items()}
+        waiting_on = collections.defaultdict(set)  # download -> targets waiting for it
+        for target, needed in targets.items():
+            for dep_target in needed:
+                waiting_on[dep_target].add(target)
+        test_dist_futures = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as check_executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=max_download_workers) as download_executor:
+
+            def _on_downloaded(download_target, future):
+                if future.exception():
+                    print(f'ERROR: Failed to download Packages file for {download_target}: {future.exception()!r}')
+                # Failed downloads still release their waiters: test_dist skips targets with missing files
+                with lock:
+                    for target in waiting_on[download_target]:
+                        remaining[target].discard(download_target)
+                        if not remaining[target]:
+                            # pylint: disable=consider-using-f-string
+                            test_dist_futures.append(check_executor.submit(
+                                self.test_dist, target, os.path.join(outdir, 'Installcheck_%s_%s_%s_%s.txt' % target),
+                                use_cache=use_cache, prune_background=prune_background, incremental=incremental))
+
+            download_futures = []
+            for download_target in to_download:
+                future = download_executor.submit(self.download_packages_file, download_target,
+                                                  skip_download=skip_download, use_cache=use_cache)
+                future.add_done_callback(functools.partial(_on_downloaded, download_target))
+                download_futures.append(future)
             concurrent.futures.wait(download_futures)
 
-            test_dist_futures = {
-                # pylint: disable=consider-using-f-string
-                executor.submit(self.test_dist, target,
-                                os.path.join(outdir, 'Installcheck_%s_%s_%s_%s.txt' % target))
-                for target in targets
-            }
-            concurrent.futures.wait(test_dist_futures)
+            # All checks have been submitted once the downloads' callbacks have run
+            download_executor.shutdown(wait=True)
+            with lock:
+                futures = list(test_dist_futures)
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception():
+                    print(f'ERROR: installcheck failed: {future.exception()!r}')
+        self.close_packages_indexes()
+        if self.results_store:
+            self.results_store.close()
+            self.results_store = None
+
+        if use_cache:
+            self.prune_cached_results()
+            self.prune_incremental_state({self.get_packages_filename(target) for target in targets})
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("-t", "--tempdir", help="sets the temporary directory to download Packages files into", type=str, default=tempfile.mkdtemp())
     parser.add_argument("-o", "--outdir", help="sets the output directory to write results to", type=str, default=os.getcwd())
+    parser.add_argument("-C", "--cache-dir", help="persistent directory for Packages files (overrides --tempdir); files are only downloaded again if they changed according to the Release file", type=str)
     parser.add_argument("-s", "--skip-download", help="skips downloading new Packages file (most useful with a custom tempdir)", action='store_true')
-    parser.add_argument("-p", "--processes", help="amount of processes to use (defaults to amount of CPU cores)", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("-p", "--processes", help="amount of dose-debcheck processes to run at once (defaults to amount of CPU cores)", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("-j", "--download-workers", help="amount of Packages files to download at once", type=int, default=4)
     parser.add_argument("-c", "--config", help="path to config file", default='installcheck.yml')
+    parser.add_argument("--full-check", help="check every package, even if results from the previous run (with --cache-dir) could be reused for unchanged packages", action='store_true')
+    parser.add_argument("--results-db", help="path to the SQLite database to record failures in (defaults to installcheck.sqlite in the cache directory with --cache-dir; otherwise failures are not recorded)")
+    parser.add_argument("--full-background", help="pass whole background Packages files to dose-debcheck instead of only the packages that each target could depend on", action='store_true')
+    runmetrics.add_arguments(parser)
     args = parser.parse_args()
 
     if not shutil.which('dose-debcheck'):
         raise OSError("Could not find 'dose-debcheck' in the PATH!")
 
+    if args.cache_dir:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        args.tempdir = args.cache_dir
     print('Using %s as tempdir' % args.tempdir)
     print('Using %s as outdir' % args.outdir)
 
-    runner = InstallCheck(args.config)
-    runner.run(args.outdir, skip_download=args.skip_download, max_workers=args.processes, tmpdir=args.tempdir)
+    # run() changes into the tempdir, so resolve output paths relative to where we were started
+    for option in ('metrics_textfile', 'metrics_json', 'profile'):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+
+    metrics = runmetrics.RunMetrics.from_args('installcheck', args)
+    runner = InstallCheck(args.config, metrics=metrics)
+    try:
+        runmetrics.run_profiled(
+            lambda: runner.run(args.outdir, skip_download=args.skip_download, max_workers=args.processes, tmpdir=args.tempdir,
+                               use_cache=bool(args.cache_dir), max_download_workers=args.download_workers,
+                               prune_background=not args.full_background, incremental=not args.full_check,
+                               results_db=args.results_db),
+            args.profile)
+    finally:
+        metrics.finish()
 
 if __name__ == '__main__':
     main()
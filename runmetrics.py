@@ -0,0 +1,165 @@
+"""
+Lightweight per-phase timing and metrics export shared by the Python scripts in this repository.
+
+Phases record wall time, item counts and bytes processed, optionally per target. Results can be
+written as a Prometheus textfile-collector file and/or a JSON run summary.
+"""
+import argparse
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+class PhaseStats():
+    """Accumulated stats for one (phase, target) pair."""
+    __slots__ = ('seconds', 'items', 'bytes', 'calls', '_lock')
+
+    def __init__(self, lock):
+        self._lock = lock  # Shared with the RunMetrics that owns these stats
+        self.seconds = 0.0
+        self.items = 0
+        self.bytes = 0
+        self.calls = 0
+
+    def add(self, items=0, nbytes=0):
+        """Adds to the item and byte counts of this phase."""
+        with self._lock:
+            self.items += items
+            self.bytes += nbytes
+
+class RunMetrics():
+    """
+    Records stats for phases of a script run. This is safe to use from multiple threads.
+    """
+    def __init__(self, job, textfile=None, json_file=None):
+        self.job = job
+        self.textfile = textfile
+        self.json_file = json_file
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears all recorded stats and restarts the run timer, e.g. between runs of a long-running process."""
+        with self._lock:
+            self.start_time = time.time()
+            self._start = time.perf_counter()
+            self._phases = collections.defaultdict(lambda: PhaseStats(self._lock))
+
+    @classmethod
+    def from_environ(cls, job):
+        """Creates a RunMetrics using output paths from the METRICS_TEXTFILE and METRICS_JSON environment variables."""
+        return cls(job, textfile=os.environ.get('METRICS_TEXTFILE'), json_file=os.environ.get('METRICS_JSON'))
+
+    @classmethod
+    def from_args(cls, job, args):
+        """Creates a RunMetrics using output paths from arguments added by add_arguments()."""
+        return cls(job, textfile=args.metrics_textfile, json_file=args.metrics_json)
+
+    def get(self, phase, target=None):
+        """Returns the PhaseStats for a phase and (optional) target, e.g. to add counts outside of phase()."""
+        with self._lock:
+            return self._phases[(phase, target)]
+
+    @contextlib.contextmanager
+    def phase(self, phase, target=None):
+        """
+        Context manager that times a phase, yielding its PhaseStats so that items and bytes can be added.
+        Time from repeated or concurrent uses of the same phase and target is summed.
+        """
+        stats = self.get(phase, target)
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stats.seconds += elapsed
+                stats.calls += 1
+
+    def summary(self):
+        """Returns a JSON-serializable summary of the run."""
+        with self._lock:
+            phases = [{
+                'phase': phase,
+                'target': target,
+                'seconds': round(stats.seconds, 6),
+                'calls': stats.calls,
+                'items': stats.items,
+                'bytes': stats.bytes,
+            } for (phase, target), stats in self._phases.items()]
+        return {
+            'job': self.job,
+            'start_time': self.start_time,
+            'seconds': round(time.perf_counter() - self._start, 6),
+            'phases': phases,
+        }
+
+    def write_prometheus(self, filename):
+        """Writes metrics in Prometheus text format, for use with node_exporter's textfile collector."""
+        summary = self.summary()
+        lines = []
+
+        def _labels(entry):
+            labels = {'job': self.job, 'phase': entry['phase']}
+            if entry['target'] is not None:
+                labels['target'] = entry['target']
+            return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items())
+
+        for metric, key, help_text in [
+            ('utopia_script_phase_seconds', 'seconds', 'Wall time spent in each phase'),
+            ('utopia_script_phase_items', 'items', 'Items processed in each phase'),
+            ('utopia_script_phase_bytes', 'bytes', 'Bytes processed in each phase'),
+        ]:
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} gauge')
+            for entry in summary['phases']:
+                lines.append(f'{metric}{{{_labels(entry)}}} {entry[key]}')
+        lines.append('# HELP utopia_script_run_seconds Total wall time of the last run')
+        lines.append('# TYPE utopia_script_run_seconds gauge')
+        lines.append(f'utopia_script_run_seconds{{job="{self.job}"}} {summary["seconds"]}')
+        lines.append('# HELP utopia_script_last_run_timestamp_seconds Start time of the last run')
+        lines.append('# TYPE utopia_script_last_run_timestamp_seconds gauge')
+        lines.append(f'utopia_script_last_run_timestamp_seconds{{job="{self.job}"}} {summary["start_time"]}')
+
+        # The textfile collector may read at any time, so write atomically
+        tmp_filename = f'{filename}.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_filename, filename)
+
+    def write_json(self, filename):
+        """Writes a JSON summary of the run."""
+        tmp_filename = f'{filename}.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            json.dump(self.summary(), f, indent=4)
+        os.replace(tmp_filename, filename)
+
+    def finish(self):
+        """Writes the configured outputs."""
+        if self.textfile:
+            self.write_prometheus(self.textfile)
+        if self.json_file:
+            self.write_json(self.json_file)
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Adds --metrics-textfile, --metrics-json and --profile options to an ArgumentParser."""
+    parser.add_argument("--metrics-textfile", help="write per-phase metrics to this file in Prometheus text format",
+                        default=os.environ.get('METRICS_TEXTFILE'))
+    parser.add_argument("--metrics-json", help="write a JSON summary of per-phase metrics to this file",
+                        default=os.environ.get('METRICS_JSON'))
+    parser.add_argument("--profile", help="run under cProfile and write stats to this file",
+                        default=os.environ.get('PROFILE_OUTPUT'))
+
+def run_profiled(func, profile_output=None):
+    """Runs func(), under cProfile if profile_output is set (stats are written there for use with pstats)."""
+    if not profile_output:
+        return func()
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(profile_output)
+        print(f'Wrote profile to {profile_output}')
@@ -15,6 +15,8 @@ import socket
 
 import requests
 
+import runmetrics
+
 ### BEGIN CONFIGURATION
 
 # Determines where the snapshot list from the last execution should be stored.
@@ -32,59 +34,75 @@ DIFF_FILENAME_FORMAT = '{1}_{2}.txt'
 
 ### END CONFIGURATION
 
-os.makedirs(OUTDIR, exist_ok=True)
-text = subprocess.check_output(['aptly', 'publish', 'list']).decode()
-try:
-    with open(FILENAME) as f:
-        ORIG_SNAPSHOT_LIST = json.load(f)
-    print('Got existing snapshot list:')
-    pprint.pprint(ORIG_SNAPSHOT_LIST)
-except (ValueError, OSError):
-    print('Failed to open %s, ignoring' % FILENAME)
-    ORIG_SNAPSHOT_LIST = {}
-
-SNAPSHOT_LIST = {}
-
-for line in text.splitlines():
-    line = line.strip()
-    match = re.match(r"""^\* (.*?) \[(.*?)\] publishes (\{.*?\}[,]?)+$""", line)
-    if match:
-        target, archs, raw_snapshots = match.groups()
-        print('Publish target %s' % target)
-        print('    archs: %s' % archs)
-        print('    snapshots: %s' % raw_snapshots)
-        snapshots = re.findall(r"""\{(.*?)\: \[(.*?)\]""", raw_snapshots)
-        print('    filtered snapshots: %s' % snapshots)
-        for snapshot_pair in snapshots:
-            # JSON doesn't allow lists as indices, so we lazily join the dist and component here...
-            snid = '%s///%s' % (target, snapshot_pair[0])
-            SNAPSHOT_LIST[snid] = snapshot = snapshot_pair[1]
-
-            old_snapshot = ORIG_SNAPSHOT_LIST.get(snid)
-            if snapshot != old_snapshot:
-                if not old_snapshot:
-                    print('Skipping first announce for repository %s' % snapshot)
-                    continue
-                print('NEW snapshot for %s: %s -> %s' % (target, old_snapshot, snapshot))
-                diff = subprocess.check_output(['aptly', 'snapshot', 'diff', old_snapshot, snapshot]).decode()
-
-                diff_filename = DIFF_FILENAME_FORMAT.format(target, old_snapshot, snapshot)
-                diff_outpath = os.path.join(OUTDIR, diff_filename)
-                print('Writing diff to %s:' % diff_outpath)
-                print(diff)
-                with open(diff_outpath, 'w') as diff_f:
-                    diff_f.write('Changes from %s to %s:\n' % (old_snapshot, snapshot))
-                    diff_f.write(diff)
-
-                if announce_url := os.environ.get('WEBHOOK_URL'):
-                    announce_text = ANNOUNCE_FORMAT.format(target.lstrip('/.'), old_snapshot, snapshot, diff_filename)
-                    payload = {'text': announce_text}
-                    requests.post(announce_url, json={'text': announce_text})
-                else:
-                    print("Skipping announce as WEBHOOK_URL environment variable is not set")
-
-print()
-print('Writing publish list to %s:' % FILENAME)
-pprint.pprint(SNAPSHOT_LIST)
-with open(FILENAME, 'w') as f:
-    json.dump(SNAPSHOT_LIST, f, indent=4)
+# Metrics output paths are read from the METRICS_TEXTFILE and METRICS_JSON environment variables, and
+# PROFILE_OUTPUT enables profiling
+metrics = runmetrics.RunMetrics.from_environ('snapshots')
+
+def main():
+    os.makedirs(OUTDIR, exist_ok=True)
+    with metrics.phase('publish_list') as stats:
+        text = subprocess.check_output(['aptly', 'publish', 'list']).decode()
+        stats.add(nbytes=len(text))
+    try:
+        with open(FILENAME) as f:
+            orig_snapshot_list = json.load(f)
+        print('Got existing snapshot list:')
+        pprint.pprint(orig_snapshot_list)
+    except (ValueError, OSError):
+        print('Failed to open %s, ignoring' % FILENAME)
+        orig_snapshot_list = {}
+
+    snapshot_list = {}
+
+    for line in text.splitlines():
+        line = line.strip()
+        match = re.match(r"""^\* (.*?) \[(.*?)\] publishes (\{.*?\}[,]?)+$""", line)
+        if match:
+            target, archs, raw_snapshots = match.groups()
+            print('Publish target %s' % target)
+            print('    archs: %s' % archs)
+            print('    snapshots: %s' % raw_snapshots)
+            snapshots = re.findall(r"""\{(.*?)\: \[(.*?)\]""", raw_snapshots)
+            print('    filtered snapshots: %s' % snapshots)
+            for snapshot_pair in snapshots:
+                # JSON doesn't allow lists as indices, so we lazily join the dist and component here...
+                snid = '%s///%s' % (target, snapshot_pair[0])
+                snapshot_list[snid] = snapshot = snapshot_pair[1]
+
+                old_snapshot = orig_snapshot_list.get(snid)
+                if snapshot != old_snapshot:
+                    if not old_snapshot:
+                        print('Skipping first announce for repository %s' % snapshot)
+                        continue
+                    print('NEW snapshot for %s: %s -> %s' % (target, old_snapshot, snapshot))
+                    with metrics.phase('diff', target) as stats:
+                        diff = subprocess.check_output(['aptly', 'snapshot', 'diff', old_snapshot, snapshot]).decode()
+                        stats.add(items=1, nbytes=len(diff))
+
+                    diff_filename = DIFF_FILENAME_FORMAT.format(target, old_snapshot, snapshot)
+                    diff_outpath = os.path.join(OUTDIR, diff_filename)
+                    print('Writing diff to %s:' % diff_outpath)
+                    print(diff)
+                    with open(diff_outpath, 'w') as diff_f:
+                        diff_f.write('Changes from %s to %s:\n' % (old_snapshot, snapshot))
+                        diff_f.write(diff)
+
+                    if announce_url := os.environ.get('WEBHOOK_URL'):
+                        announce_text = ANNOUNCE_FORMAT.format(target.lstrip('/.'), old_snapshot, snapshot, diff_filename)
+                        payload = {'text': announce_text}
+                        requests.post(announce_url, json={'text': announce_text})
+                    else:
+                        print("Skipping announce as WEBHOOK_URL environment variable is not set")
+
+    print()
+    print('Writing publish list to %s:' % FILENAME)
+    pprint.pprint(snapshot_list)
+    with open(FILENAME, 'w') as f:
+        json.dump(snapshot_list, f, indent=4)
+
+if __name__ == '__main__':
+    try:
+        runmetrics.run_profiled(main, os.environ.get('PROFILE_OUTPUT'))
+    finally:
+        # Also record metrics for failed runs
+        metrics.finish()
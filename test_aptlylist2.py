@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Tests for aptlylist2.py's JSON streaming, source package extraction, caches and HTML output.
+
+Run with: python3 -m unittest test_aptlylist2
+"""
+
+import gzip
+import io
+import os
+import tarfile
+import tempfile
+import time
+import unittest
+
+import aptlylist2
+
+def _make_tarball(filename, members):
+    """Writes an uncompressed tarball of (name, data) members, where data None means a directory."""
+    with tarfile.open(filename, 'w') as tar_f:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                tar_f.addfile(info)
+            else:
+                info.size = len(data)
+                tar_f.addfile(info, io.BytesIO(data))
+
+class IterJsonArrayTest(unittest.TestCase):
+    def parse(self, data, chunk_size):
+        chunks = [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
+        return list(aptlylist2._iter_json_array(chunks))
+
+    def test_chunk_boundaries(self):
+        data = '[{"Package": "foo", "Description": "caf\u00e9 ] , [ \\\\ \\""}, {"Package": "bär"},\n {"a": [1, {"b": 2}]}]'.encode()
+        expected = [{'Package': 'foo', 'Description': 'caf\u00e9 ] , [ \\ "'}, {'Package': 'bär'}, {'a': [1, {'b': 2}]}]
+        # Splits elements, escapes and multibyte characters across chunks
+        for chunk_size in range(1, len(data) + 1):
+            self.assertEqual(self.parse(data, chunk_size), expected, chunk_size)
+
+    def test_empty(self):
+        self.assertEqual(self.parse(b'[]', 1), [])
+        self.assertEqual(self.parse(b' \n[ ]\n', 1), [])
+
+    def test_stops_at_end_of_array(self):
+        self.assertEqual(self.parse(b'[{"a": 1}] trailing', 4), [{'a': 1}])
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            self.parse(b'{"error": "not found"}', 4)
+
+    def test_truncated(self):
+        for data in (b'', b'[', b'[{"a": 1}', b'[{"a": 1}, {"b"'):
+            with self.assertRaises(ValueError):
+                self.parse(data, 3)
+
+class ExtractMetadataTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.pool_dir = tmpdir.name
+        os.makedirs(os.path.join(self.pool_dir, 'main', 'f', 'foo'))
+
+    def extract(self, version, tarball_name, members, truncate=None, **kwargs):
+        filename = os.path.join(self.pool_dir, 'main', 'f', 'foo', tarball_name)
+        _make_tarball(filename, members)
+        if truncate:
+            with open(filename, 'r+b') as f:
+                f.truncate(truncate)
+        entry = aptlylist2.PackageEntry('foo', version, 'source', 'foo', 'main', [f'foo_{version}.dsc', tarball_name])
+        return entry.extract_metadata(self.pool_dir, 0, **kwargs)
+
+    def test_debian_tarball(self):
+        result = self.extract('1.0-1', 'foo_1.0-1.debian.tar', [
+            ('debian', None),
+            ('debian/changelog', b'CL'),
+            ('debian/source', None),
+            ('debian/source/format', b'3.0 (quilt)\n'),
+            ('debian/watch', b'W'),
+        ])
+        self.assertEqual(result, (b'CL', b'W'))
+
+    def test_native_tarball_with_watch(self):
+        result = self.extract('1.0', 'foo_1.0.tar', [
+            ('foo-1.0', None),
+            ('foo-1.0/README', b'readme'),
+            ('foo-1.0/debian', None),
+            ('foo-1.0/debian/changelog', b'CL'),
+            ('foo-1.0/debian/watch', b'W'),
+            ('foo-1.0/src', None),
+        ])
+        self.assertEqual(result, (b'CL', b'W'))
+
+    def test_stops_after_debian_dir(self):
+        # A watch file outside of the debian/ directory's listing isn't looked for
+        result = self.extract('1.0', 'foo_1.0.tar', [
+            ('./foo-1.0/', None),
+            ('./foo-1.0/debian/', None),
+            ('./foo-1.0/debian/changelog', b'CL'),
+            ('./foo-1.0/src/', None),
+            ('./foo-1.0/debian/watch', b'W'),
+        ])
+        self.assertEqual(result, (b'CL', None))
+
+    def test_stops_without_reading_rest(self):
+        # The tarball is cut off in the middle of the upstream sources, which are never read
+        members = [
+            ('foo-1.0/debian', None),
+            ('foo-1.0/debian/changelog', b'CL'),
+            ('foo-1.0/src', None),
+            ('foo-1.0/src/big.c', b'x' * 100000),
+        ]
+        self.assertEqual(self.extract('1.0', 'foo_1.0.tar', members, truncate=20000), (b'CL', None))
+        self.assertEqual(self.extract('1.0', 'foo_1.0.tar', members, truncate=20000, extract_watchfile=False),
+                         (b'CL', None))
+
+    def test_ignores_nested_debian_dirs(self):
+        result = self.extract('1.0', 'foo_1.0.tar', [
+            ('foo-1.0', None),
+            ('foo-1.0/vendor/bar/debian', None),
+            ('foo-1.0/vendor/bar/debian/changelog', b'vendored'),
+            ('foo-1.0/debian', None),
+            ('foo-1.0/debian/changelog', b'CL'),
+        ])
+        self.assertEqual(result, (b'CL', None))
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def test_lru_cache(self):
+        cache = aptlylist2.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(set(cache), {'a', 'c'})
+        # Replacing an entry also makes it the most recently used
+        cache['a'] = 4
+        cache['d'] = 5
+        self.assertEqual(dict(cache), {'a': 4, 'd': 5})
+        self.assertIsNone(cache.get('b'))
+
+    def test_extraction_cache_pruned_on_sync(self):
+        cache = aptlylist2.ExtractionCache(os.path.join(self.tmpdir, 'extraction'), 60, prune_interval=0)
+        self.addCleanup(cache.close)
+        cache.put('old', b'CL', b'W')
+        cache.put('new', b'CL', b'W')
+        cache.sync()
+        cache.last_used['old'] -= 120
+        cache.sync()
+        self.assertIsNone(cache.get('old'))
+        self.assertEqual(cache.get('new'), (b'CL', b'W'))
+
+    def test_uscan_cache_pruned_on_sync(self):
+        cache = aptlylist2.UscanCache(os.path.join(self.tmpdir, 'uscan'), 60, prune_interval=3600)
+        self.addCleanup(cache.close)
+        cache.put('old', ('up to date', '1.0', None))
+        cache.db['old'] = {**cache.db['old'], 'time': time.time() - 120}
+        cache.sync()
+        # Not due for pruning yet
+        self.assertIn('old', cache.db)
+        cache.last_pruned -= 3600
+        cache.sync()
+        self.assertNotIn('old', cache.db)
+
+class WritePageTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.filename = os.path.join(tmpdir.name, 'sid_main.html')
+        self.list_engine = aptlylist2.AptlyList.__new__(aptlylist2.AptlyList)
+        self.list_engine.config = {'html': {'repo_name': 'Test', 'precompress': ['gz']}}
+
+    def test_precompress(self):
+        written = self.list_engine.write_page(self.filename, 'sid/main', iter(['<table>', '<tr></tr>' * 1000, '</table>']), 1000)
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        self.assertIn(b'<br><br>\n<table>' + b'<tr></tr>' * 1000 + b'</table>\n<p><b>Total items:</b> 1000</p>', data)
+        with gzip.open(f'{self.filename}.gz', 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(written, len(data) + os.path.getsize(f'{self.filename}.gz'))
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.filename))), ['sid_main.html', 'sid_main.html.gz'])
+
+    def test_disabled_format_removed(self):
+        self.list_engine.write_page(self.filename, 'sid/main', ['old'], 0)
+        self.list_engine.config['html']['precompress'] = []
+        self.list_engine.write_page(self.filename, 'sid/main', ['new'], 0)
+        self.assertEqual(os.listdir(os.path.dirname(self.filename)), ['sid_main.html'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Tests for aptlysc.py's Debian version comparison.
+
+Run with: python3 -m unittest test_aptlysc
+"""
+
+import unittest
+
+import aptlysc
+
+class CompareVersionsTest(unittest.TestCase):
+    def assertOrder(self, a, b, expected):
+        result = aptlysc.compare_versions(a, b)
+        self.assertEqual((result > 0) - (result < 0), expected, f'{a} vs {b}')
+        result = aptlysc.compare_versions(b, a)
+        self.assertEqual((result > 0) - (result < 0), -expected, f'{b} vs {a}')
+
+    def test_epochs(self):
+        self.assertOrder('1:1.0', '2.0', 1)
+        self.assertOrder('0:1.0', '1.0', 0)
+        self.assertOrder('2:1.0-1', '10:0.1-1', -1)
+        # Only the first colon ends the epoch
+        self.assertOrder('1:1.0:2-1', '1:1.0:10-1', -1)
+
+    def test_tilde(self):
+        self.assertOrder('1.0~rc1', '1.0', -1)
+        self.assertOrder('1.0~~', '1.0~', -1)
+        self.assertOrder('1.0~rc1', '1.0~rc2', -1)
+        self.assertOrder('2:1.0~beta1-1', '2:1.0-0', -1)
+
+    def test_revisions(self):
+        self.assertOrder('1.0-2', '1.0-1', 1)
+        self.assertOrder('1.0-10', '1.0-9', 1)
+        self.assertOrder('1.0', '1.0-0', 0)
+        # Only the last hyphen starts the revision
+        self.assertOrder('1.0-1-2', '1.0-1-10', -1)
+
+    def test_verrevcmp(self):
+        self.assertLess(aptlysc._verrevcmp('1.2', '1.10'), 0)
+        self.assertEqual(aptlysc._verrevcmp('1.002', '1.2'), 0)
+        # Letters sort before other characters
+        self.assertLess(aptlysc._verrevcmp('1.0a', '1.0+'), 0)
+        self.assertLess(aptlysc._verrevcmp('1.0', '1.0a'), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Tests for installcheck.py's Packages downloads, pdiff handling, dose-debcheck report parsing and incremental checks.
+
+Run with: python3 -m unittest test_installcheck
+"""
+
+import hashlib
+import io
+import gzip
+import json
+import lzma
+import os
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+import yaml
+
+import installcheck
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+class _FakeResponse():
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.status_code = 200
+        self.headers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        return iter(self.chunks)
+
+class DownloadTest(unittest.TestCase):
+    def download(self, extension, chunks):
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(installcheck.requests, 'get', return_value=_FakeResponse(chunks)):
+            filename = os.path.join(tmpdir, 'Packages')
+            result = installcheck.try_download_packages_file('http://localhost/Packages', filename, extension)
+            if not result:
+                return None
+            with open(filename, 'rb') as f:
+                data = f.read()
+            self.assertEqual(result.sha256, _sha256(data))
+            return data
+
+    def test_multiple_xz_streams(self):
+        first, second = lzma.compress(b'Package: a\n\n'), lzma.compress(b'Package: b\n')
+        expected = b'Package: a\n\nPackage: b\n'
+        # Streams ending on a chunk boundary, in the middle of a chunk and followed by padding
+        self.assertEqual(self.download('xz', [first, second]), expected)
+        self.assertEqual(self.download('xz', [first + second[:10], second[10:]]), expected)
+        self.assertEqual(self.download('xz', [first + b'\0' * 4, b'\0' * 4, second + b'\0' * 4]), expected)
+
+    def test_multiple_gz_streams(self):
+        first, second = gzip.compress(b'Package: a\n\n'), gzip.compress(b'Package: b\n')
+        self.assertEqual(self.download('gz', [first, second]), b'Package: a\n\nPackage: b\n')
+
+    def test_truncated(self):
+        data = lzma.compress(b'Package: a\n')
+        self.assertIsNone(self.download('xz', [data[:-4]]))
+
+# Three versions of a Packages file, and the ed scripts between them
+_PACKAGES_V0 = b'a\nb\nc\nd\n'
+_PACKAGES_V1 = b'b\nC\nd\n'
+_PACKAGES_V2 = b'b\nC\nd\ne\n'
+_PATCH_V0_V1 = b'3c\nC\n.\n1d\n'
+_PATCH_V1_V2 = b'3a\ne\n.\n'
+_PATCH_V0_V2 = b'4a\ne\n.\n3c\nC\n.\n1d\n'
+
+def _pdiff_index(history, patches, merged=False):
+    """Builds a Packages.diff/Index file for the given (old file, patch name) history and patches."""
+    lines = [f'SHA256-Current: {_sha256(_PACKAGES_V2)} {len(_PACKAGES_V2)}', 'SHA256-History:']
+    lines += [f' {_sha256(data)} {len(data)} {name}' for data, name in history]
+    lines.append('SHA256-Patches:')
+    lines += [f' {_sha256(patch)} {len(patch)} {name}' for name, patch in patches.items()]
+    lines.append('SHA256-Download:')
+    lines += [f' {_sha256(patch + b"gz")} {len(patch)} {name}.gz' for name, patch in patches.items()]
+    if merged:
+        lines.append('X-Patch-Precedence: merged')
+    return '\n'.join(lines) + '\n'
+
+class PdiffTest(unittest.TestCase):
+    def apply(self, patch, data):
+        out_f = io.BytesIO()
+        sha256 = installcheck.apply_ed_patch(patch, io.BytesIO(data), out_f)
+        self.assertEqual(sha256, _sha256(out_f.getvalue()))
+        return out_f.getvalue()
+
+    def test_parse_chained_index(self):
+        patches = {'T-2024-01-01': _PATCH_V0_V1, 'T-2024-01-02': _PATCH_V1_V2}
+        index = installcheck.parse_pdiff_index(_pdiff_index(
+            [(_PACKAGES_V0, 'T-2024-01-01'), (_PACKAGES_V1, 'T-2024-01-02')], patches))
+        self.assertEqual(index['current'], _sha256(_PACKAGES_V2))
+        self.assertEqual(index['history'], [(_sha256(_PACKAGES_V0), 'T-2024-01-01'),
+                                            (_sha256(_PACKAGES_V1), 'T-2024-01-02')])
+        self.assertEqual(index['patches'], {name: _sha256(patch) for name, patch in patches.items()})
+        self.assertEqual(index['downloads'], {name: _sha256(patch + b'gz') for name, patch in patches.items()})
+        self.assertFalse(index['merged'])
+
+    def test_parse_merged_index(self):
+        index = installcheck.parse_pdiff_index(_pdiff_index(
+            [(_PACKAGES_V0, 'T-2024-01-01'), (_PACKAGES_V1, 'T-2024-01-02')],
+            {'T-2024-01-01': _PATCH_V0_V2, 'T-2024-01-02': _PATCH_V1_V2}, merged=True))
+        self.assertTrue(index['merged'])
+        self.assertEqual(index['patches']['T-2024-01-01'], _sha256(_PATCH_V0_V2))
+
+    def test_apply_chained(self):
+        self.assertEqual(self.apply(_PATCH_V0_V1, _PACKAGES_V0), _PACKAGES_V1)
+        self.assertEqual(self.apply(_PATCH_V1_V2, self.apply(_PATCH_V0_V1, _PACKAGES_V0)), _PACKAGES_V2)
+
+    def test_apply_merged(self):
+        self.assertEqual(self.apply(_PATCH_V0_V2, _PACKAGES_V0), _PACKAGES_V2)
+
+    def test_apply_invalid(self):
+        with self.assertRaises(ValueError):
+            self.apply(b'1,2s/a/b/\n', _PACKAGES_V0)
+        with self.assertRaises(ValueError):
+            self.apply(b'1a\nx\n', _PACKAGES_V0)
+        with self.assertRaises(ValueError):
+            self.apply(b'9d\n', _PACKAGES_V0)
+        with self.assertRaises(ValueError):
+            self.apply(b'1d\n3d\n', _PACKAGES_V0)
+
+_MISSING_ENTRY = '''\
+ -
+  package: foo
+  version: 1.0
+  architecture: amd64
+  status: broken
+  reasons:
+   -
+    missing:
+     pkg:
+      package: foo
+      version: 1.0
+      architecture: amd64
+      unsat-dependency: libmissing (>= 2)
+     depchains:
+      -
+       depchain:
+        -
+         package: foo
+         version: 1.0
+'''
+_CONFLICT_ENTRY = '''\
+ -
+  package: bar
+  version: 2.0
+  architecture: all
+  status: broken
+  reasons:
+   -
+    conflict:
+     pkg1:
+      package: bar
+      version: 2.0
+      architecture: all
+      unsat-conflict: baz (<< 3)
+     pkg2:
+      package: baz
+      version: 1.0
+      architecture: amd64
+     depchain1:
+      -
+       depchain:
+        -
+         package: bar
+         version: 2.0
+'''
+
+def _dose_report(*entries):
+    report = 'output-version: 1.2\nnative-architecture: amd64\n'
+    if entries:
+        report += 'report:\n' + ''.join(entries)
+    return report + textwrap.dedent(f'''\
+
+        background-packages: 10
+        foreground-packages: 4
+        total-packages: 14
+        broken-packages: {len(entries)}
+        missing-packages: 1
+        conflict-packages: 1
+        ''')
+
+class DoseReportTest(unittest.TestCase):
+    def test_iter_dose_report(self):
+        items = list(installcheck.iter_dose_report(io.StringIO(_dose_report(_MISSING_ENTRY, _CONFLICT_ENTRY))))
+        entries = [(package, ''.join(lines)) for package, lines in items if package is not None]
+        self.assertEqual(entries, [('foo', _MISSING_ENTRY), ('bar', _CONFLICT_ENTRY)])
+        other_lines = [line for package, line in items if package is None]
+        self.assertIn('report:\n', other_lines)
+        self.assertIn('broken-packages: 2\n', other_lines)
+
+    def test_parse_missing(self):
+        fields, reasons = installcheck.parse_dose_entry(_MISSING_ENTRY.splitlines(keepends=True))
+        self.assertEqual(fields, {'package': 'foo', 'version': '1.0', 'architecture': 'amd64', 'status': 'broken'})
+        self.assertEqual(reasons, [{
+            'type': 'missing',
+            'pkg': {'package': 'foo', 'version': '1.0', 'architecture': 'amd64', 'unsat-dependency': 'libmissing (>= 2)'},
+        }])
+
+    def test_parse_conflict(self):
+        fields, reasons = installcheck.parse_dose_entry(_CONFLICT_ENTRY.splitlines(keepends=True))
+        self.assertEqual(fields['package'], 'bar')
+        self.assertEqual(reasons, [{
+            'type': 'conflict',
+            'pkg1': {'package': 'bar', 'version': '2.0', 'architecture': 'all', 'unsat-conflict': 'baz (<< 3)'},
+            'pkg2': {'package': 'baz', 'version': '1.0', 'architecture': 'amd64'},
+        }])
+
+    def test_iter_dose_failures(self):
+        failures = list(installcheck.iter_dose_failures(io.StringIO(_dose_report(_MISSING_ENTRY, _CONFLICT_ENTRY))))
+        self.assertEqual(failures, [
+            {'package': 'foo', 'version': '1.0', 'architecture': 'amd64', 'reason': 'missing', 'culprit': 'foo',
+             'relation': 'libmissing (>= 2)', 'conflict_package': None},
+            {'package': 'bar', 'version': '2.0', 'architecture': 'all', 'reason': 'conflict', 'culprit': 'bar',
+             'relation': 'baz (<< 3)', 'conflict_package': 'baz (1.0)'},
+        ])
+_GONE_ENTRY = _MISSING_ENTRY.replace('package: foo', 'package: qux')
+_NEW_ENTRY = _MISSING_ENTRY.replace('package: foo', 'package: new')
+
+class MergeDoseReportsTest(unittest.TestCase):
+    def merge(self, old_report, new_report, checked, packages):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = [os.path.join(tmpdir, name) for name in ('old', 'new', 'out')]
+            for filename, report in zip(filenames, (old_report, new_report)):
+                with open(filename, 'w', encoding='utf8') as f:
+                    f.write(report)
+            count = installcheck.merge_dose_reports(*filenames, checked, packages)
+            with open(filenames[2], encoding='utf8') as f:
+                return count, f.read()
+
+    def test_merge(self):
+        # foo was fixed, new is newly broken, bar wasn't checked again and qux is no longer in the foreground
+        count, merged = self.merge(_dose_report(_MISSING_ENTRY, _CONFLICT_ENTRY, _GONE_ENTRY), _dose_report(_NEW_ENTRY),
+                                   checked={'foo', 'new'}, packages={'foo', 'bar', 'new'})
+        self.assertEqual(count, 2)
+        entries = [package for package, _lines in installcheck.iter_dose_report(io.StringIO(merged)) if package]
+        self.assertEqual(entries, ['bar', 'new'])
+        self.assertIn('broken-packages: 2\n', merged)
+        self.assertNotIn('missing-packages:', merged)
+        self.assertNotIn('conflict-packages:', merged)
+
+    def test_merge_without_new_report(self):
+        # Nothing was checked again, but qux was removed from the foreground
+        with tempfile.TemporaryDirectory() as tmpdir:
+            old_filename, out_filename = os.path.join(tmpdir, 'old'), os.path.join(tmpdir, 'out')
+            with open(old_filename, 'w', encoding='utf8') as f:
+                f.write(_dose_report(_MISSING_ENTRY, _GONE_ENTRY))
+            count = installcheck.merge_dose_reports(old_filename, None, out_filename, set(), {'foo'})
+            with open(out_filename, encoding='utf8') as f:
+                merged = f.read()
+        self.assertEqual(count, 1)
+        entries = [package for package, _lines in installcheck.iter_dose_report(io.StringIO(merged)) if package]
+        self.assertEqual(entries, ['foo'])
+
+    def test_merge_into_empty_report(self):
+        count, merged = self.merge(_dose_report(), _dose_report(_CONFLICT_ENTRY),
+                                   checked={'bar'}, packages={'bar'})
+        self.assertEqual(count, 1)
+        self.assertIn('report:\n' + _CONFLICT_ENTRY + 'background-packages:', merged)
+        self.assertIn('broken-packages: 1\n', merged)
+
+_CONFIG = {
+    'repos': {'test': 'http://localhost/test'},
+    'target_archs': ['amd64'],
+    'target_dists': [{'repo': 'test', 'distribution': 'sid', 'suites': ['main']}],
+    'suite_dependencies': {'test/main': []},
+}
+_TARGET = installcheck.RepoTarget('test', 'sid', 'main', 'amd64')
+
+class _FakeDoseInstallCheck(installcheck.InstallCheck):
+    """InstallCheck that reports the packages in self.broken as broken instead of running dose-debcheck."""
+    broken = set()
+
+    def run_dose_debcheck(self, cmd, target_filename, report_filename):
+        checked = None
+        for arg in cmd:
+            if arg.startswith('--checkonly='):
+                checked = set(arg.removeprefix('--checkonly=').split(','))
+        self.checked = checked
+        packages = {package.decode() for package in self.get_packages_index(target_filename).packages}
+        entries = [_MISSING_ENTRY.replace('package: foo', f'package: {package}')
+                   for package in sorted(self.broken & packages) if checked is None or package in checked]
+        with open(report_filename, 'w', encoding='utf8') as f:
+            f.write(_dose_report(*entries))
+        return 1 if entries else 0
+
+class IncrementalCheckTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmpdir.name)
+        with open('installcheck.yml', 'w', encoding='utf8') as f:
+            yaml.safe_dump(_CONFIG, f)
+        self.packages_filename = installcheck.InstallCheck.get_packages_filename(_TARGET)
+
+    def write_packages(self, *packages, in_place=False):
+        data = ''.join(f'Package: {package}\nVersion: 1.0\nArchitecture: amd64\n\n' for package in packages)
+        filename = self.packages_filename if in_place else f'{self.packages_filename}.tmp'
+        with open(filename, 'w', encoding='utf8') as f:
+            f.write(data)
+        if not in_place:
+            os.replace(filename, self.packages_filename)
+
+    def check(self, broken):
+        runner = _FakeDoseInstallCheck('installcheck.yml')
+        runner.broken = broken
+        runner.checked = None
+        try:
+            runner.test_dist(_TARGET, 'out.txt', use_cache=True, incremental=True)
+        finally:
+            runner.close_packages_indexes()
+        with open('out.json', encoding='utf8') as f:
+            summary = json.load(f)
+        return runner.checked, summary['returncode'], summary['broken_packages']
+
+    def test_only_changed_packages_checked(self):
+        self.write_packages('foo', 'bar', 'baz')
+        self.assertEqual(self.check({'foo'}), (None, 1, ['foo']))
+        self.write_packages('foo', 'bar', 'baz', 'new')
+        self.assertEqual(self.check({'foo', 'new'}), ({'new'}, 1, ['foo', 'new']))
+
+    def test_long_checkonly_list(self):
+        self.write_packages('foo', 'bar', 'baz')
+        self.assertEqual(self.check({'foo'}), (None, 1, ['foo']))
+        self.write_packages('foo', 'bar', 'baz', 'new')
+        with mock.patch.object(installcheck, '_MAX_CHECKONLY_LENGTH', 3):
+            self.assertEqual(self.check({'foo', 'new'}), (None, 1, ['foo', 'new']))
+
+    def test_removed_broken_package(self):
+        self.write_packages('foo', 'bar', 'baz')
+        self.assertEqual(self.check({'foo'}), (None, 1, ['foo']))
+        # Nothing left depends on foo, so nothing is checked again, but foo must still be dropped from the report
+        self.write_packages('bar', 'baz')
+        self.assertEqual(self.check({'foo'}), (None, 0, []))
+
+    def test_packages_modified_in_place(self):
+        self.write_packages('foo', 'bar', 'baz')
+        self.assertEqual(self.check(set()), (None, 0, []))
+        # The saved copy is a hardlink to the Packages file, so it can't be diffed against anymore
+        self.write_packages('foo', 'bar', 'baz', 'new', in_place=True)
+        self.assertEqual(self.check({'new'}), (None, 1, ['new']))
+
+if __name__ == '__main__':
+    unittest.main()